@@ -0,0 +1,330 @@
+# Gateway Parcel Co. St. Louis Routing Application - benchmark suite
+# This script measures how the routing application scales. It generates synthetic package
+# manifests and distance tables in the same CSV layout as WGUPS_Package_File.csv and
+# WGUPS_Distance_Table.csv, times each stage of the pipeline separately, and writes the
+# results to a JSON file. A previous results file can be passed with --compare to flag
+# stages that got slower.
+#
+# It also times how long the program takes to start: importing main.py, and launching main.py on
+# the sample data until the answer to its first query comes back, with and without charts.
+# Before timing anything it runs the sample day in a few configurations (see SAMPLE_DAY_CHECKS) and
+# fails if any of them misses a deadline, since a faster route that delivers late is not an improvement.
+#
+# Example:
+#   python benchmark.py --packages 40 400 2000 --output bench.json
+#   python benchmark.py --packages 40 400 2000 --compare bench.json
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+import main
+
+HUB_HEADER = "Western Governors University\n4001 South 700 East, \nSalt Lake City, UT 84107"
+# Package 9 is held for a wrong address and corrected to this address at 10:20 AM (see main.ADDRESS_CORRECTIONS),
+# so every table needs it.
+CORRECTED_ADDRESS = "410 S State St"
+DELAYED_NOTE = "Delayed on flight---will not arrive to depot until 9:05 am"
+WRONG_ADDRESS_NOTE = "Wrong address listed"
+FORCED_NOTE = "Can only be on truck 2"
+PACKAGE_HEADER = ["Package\nID", "Address", "City ", "State", "Zip", "Delivery\nDeadline", "Weight\nKILO",
+                  "page 1 of 1PageSpecial Notes"]
+# The smallest manifest that has package 9, so every run times its hold and correction.
+MIN_PACKAGES = 9
+# The exhaustive two_opt is O(n^3) per pass, so I only time it on small routes.
+EXHAUSTIVE_TWO_OPT_LIMIT = 60
+# The sample-day runs checked before benchmarking: a name, the scenario settings (see main.SCENARIO_DEFAULTS)
+# and whether to use the shortest-path distances. Every one of them must deliver every package on time.
+SAMPLE_DAY_CHECKS = [
+    ("default", {}, True),
+    ("raw distances", {}, False),
+    ("events dispatcher", {"dispatcher": "events"}, True),
+    # Truck 2 leaves before the delayed flight lands, so the delayed packages must go on truck 1.
+    ("uneven start times", {"starts": "9:10 AM,8:00 AM"}, True),
+]
+
+# Function to make up a street address for synthetic location i.
+def synthetic_address(i):
+    return f"{100 + i} Synthetic Ave"
+
+# Function to write a distance table CSV with the hub, the corrected package 9 address and random locations.
+# Locations are random points in a 20 x 20 mile square and distances are straight-line miles.
+def generate_distance_table(filename, locations, seed=0):
+    rng = np.random.default_rng(seed)
+    addresses = [CORRECTED_ADDRESS] + [synthetic_address(i) for i in range(locations - 2)]
+    headers = [HUB_HEADER] + [f"Location {i}\n {address}" for i, address in enumerate(addresses, 1)]
+    points = rng.random((len(headers), 2)) * 20
+    distances = np.round(np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2)), 1)
+    with open(filename, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["DISTANCE BETWEEN HUBS IN MILES", ""] + headers)
+        for i, header in enumerate(headers):
+            # Each row only fills the lower triangle, like the real table.
+            cells = [f"{distances[i, j]:g}" for j in range(i)] + ["0"] + [""] * (len(headers) - i - 1)
+            writer.writerow([header, f" {header.split(chr(10))[-1].strip()}\n(84100)"] + cells)
+    return addresses
+
+# Function to write a package manifest CSV with deadlines, groups, delayed and forced-truck notes.
+def generate_package_file(filename, packages, addresses, seed=0):
+    rng = random.Random(seed)
+    # Package 9 gets the wrong address note, like the real manifest, so its hold and correction are timed too.
+    notes = {9: WRONG_ADDRESS_NOTE}
+    ids = [package_id for package_id in range(1, packages + 1) if package_id != 9]
+    rng.shuffle(ids)
+    # About 7% of packages are in groups of three that must be delivered together.
+    group_count = packages * 7 // 300
+    for g in range(group_count):
+        group = ids[3 * g:3 * g + 3]
+        notes[group[0]] = "Must be delivered with " + ", ".join(str(package_id) for package_id in group[1:])
+    rest = ids[3 * group_count:]
+    # About 10% are delayed and 10% can only go on truck 2.
+    tenth = packages // 10
+    for package_id in rest[:tenth]:
+        notes[package_id] = DELAYED_NOTE
+    for package_id in rest[tenth:2 * tenth]:
+        notes[package_id] = FORCED_NOTE
+
+    with open(filename, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(PACKAGE_HEADER)
+        for package_id in range(1, packages + 1):
+            roll = rng.random()
+            deadline = "9:00 AM" if roll < 0.025 else "10:30 AM" if roll < 0.35 else "EOD"
+            writer.writerow([package_id, rng.choice(addresses), "Saint Louis", "MO", "84100", deadline,
+                             rng.randint(1, 88), notes.get(package_id, "")])
+
+# Function to time a call. setup runs before each repeat and its result is passed to fn, untimed.
+def time_call(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+# Function to make the two trucks the same way main() does.
+def make_trucks():
+    trucks = [main.Truck() for _ in range(2)]
+    trucks[1].current_time = datetime.strptime("9:05 AM", "%I:%M %p")
+    return trucks
+
+# Function to generate one scenario and time each stage of the pipeline on it.
+def benchmark_scenario(packages, locations, repeat, seed, folder):
+    package_file = os.path.join(folder, f"packages_{packages}.csv")
+    distance_file = os.path.join(folder, f"distances_{locations}.csv")
+    addresses = generate_distance_table(distance_file, locations, seed)
+    generate_package_file(package_file, packages, addresses, seed)
+    timings = {}
+
+    timings["load_package_data"] = time_call(lambda: main.load_package_data(package_file), repeat)
+    timings["load_package_data (columnar)"] = time_call(
+        lambda: main.load_package_data(package_file, columnar=True), repeat)
+    timings["load_distance_data"] = time_call(lambda: main.load_distance_data(distance_file, use_cache=False), repeat)
+    # Without the shortest-path step, to show what Floyd-Warshall adds to an uncached load.
+    timings["load_distance_data (raw)"] = time_call(
+        lambda: main.load_distance_data(distance_file, use_cache=False, shortest_paths=False), repeat)
+    main.load_distance_data(distance_file)  # This writes the cache for the next measurement.
+    timings["load_distance_data (cached)"] = time_call(lambda: main.load_distance_data(distance_file), repeat)
+
+    distances, addresses = main.load_distance_data(distance_file)
+    package_hash = main.load_package_data(package_file)
+    # For route construction and 2-opt, one truck carries every package so the route covers every stop.
+    truck = main.Truck(capacity=packages)
+    truck.packages = package_hash.values()
+    timings["plan_truck_route"] = time_call(lambda: main.plan_truck_route(truck, addresses, distances), repeat)
+    timings["plan_truck_route (loop)"] = time_call(
+        lambda: main.plan_truck_route(truck, addresses, distances, vectorized=False), repeat)
+    route = main.plan_truck_route(truck, addresses, distances)
+    timings["two_opt_neighbors"] = time_call(lambda: main.two_opt_neighbors(route, addresses, distances), repeat)
+    # The deadline-aware 2-opt should keep up with the mileage-only one.
+    route_ids = distances.indices_of(route)
+    timings["two_opt_neighbors (on time)"] = time_call(
+        lambda: main.on_time_route_indices(route_ids, truck, distances), repeat)
+    if len(route) <= EXHAUSTIVE_TWO_OPT_LIMIT:
+        timings["two_opt"] = time_call(lambda: main.two_opt(route, addresses, distances), repeat)
+
+    # simulate_deliveries changes the packages it delivers, so every repeat gets a freshly loaded manifest.
+    timings["simulate_deliveries"] = time_call(
+        lambda trucks, package_hash: main.simulate_deliveries(trucks, addresses, distances, package_hash),
+        repeat,
+        setup=lambda: (make_trucks(), main.load_package_data(package_file))
+    )
+    timings["simulate_deliveries (clusters)"] = time_call(
+        lambda trucks, package_hash: main.simulate_deliveries(trucks, addresses, distances, package_hash,
+                                                              partition="clusters"),
+        repeat,
+        setup=lambda: (make_trucks(), main.load_package_data(package_file))
+    )
+    return {"packages": packages, "locations": locations, "stops": len(route) - 2, "timings": timings}
+
+# Function to start a Python process with args in folder and time how long it takes until it writes its
+# first line of output. With a query on stdin, that line is the first answer.
+def time_first_output(args, folder, stdin_text=""):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + args, cwd=folder,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    process.stdin.write(stdin_text)
+    process.stdin.close()
+    process.stdout.readline()
+    elapsed = time.perf_counter() - start
+    # I still wait for the process to exit, so background charts don't overlap the next run.
+    process.stdout.read()
+    process.wait()
+    return elapsed
+
+# Function to time startup: the import of main.py and the time to the first query answer for each chart mode.
+# main.py is run in a temporary folder with copies of the CSV files (and of the distance cache, so every run
+# starts warm), so the PNG files the chart modes write don't replace the ones in main.py's folder.
+def benchmark_startup(repeat):
+    source = os.path.dirname(os.path.abspath(main.__file__))
+    timings = {}
+    timings["import main"] = time_call(
+        lambda: subprocess.run([sys.executable, "-c", "import main"], check=True, cwd=source), repeat)
+    with tempfile.TemporaryDirectory() as folder:
+        for name in ("WGUPS_Package_File.csv", "WGUPS_Distance_Table.csv"):
+            shutil.copy2(os.path.join(source, name), folder)
+        if os.path.isdir(os.path.join(source, ".distance_cache")):
+            shutil.copytree(os.path.join(source, ".distance_cache"), os.path.join(folder, ".distance_cache"))
+        for charts in ("off", "background", "foreground"):
+            times = [time_first_output([os.path.join(source, "main.py"), "--queries", "-", "--charts", charts],
+                                       folder, "mileage\n")
+                     for _ in range(repeat)]
+            timings[f"first query, charts {charts}"] = {
+                "min": min(times), "median": statistics.median(times), "repeat": repeat}
+    return timings
+
+# Function to run the sample day for each of SAMPLE_DAY_CHECKS. Returns {name: {"late", "error", "passed"}}.
+def check_sample_day():
+    source = os.path.dirname(os.path.abspath(main.__file__))
+    package_file = os.path.join(source, "WGUPS_Package_File.csv")
+    distance_file = os.path.join(source, "WGUPS_Distance_Table.csv")
+    checks = {}
+    for name, settings, shortest_paths in SAMPLE_DAY_CHECKS:
+        distances, _ = main.load_distance_data(distance_file, shortest_paths=shortest_paths)
+        scenario = dict(main.SCENARIO_DEFAULTS, **settings)
+        row = main.run_scenario(scenario, package_file, distances)
+        checks[name] = {"late": row.get("late"), "error": row["error"],
+                        "passed": not row["error"] and row["late"] == 0}
+    return checks
+
+# Function to run every scenario size and collect the results with details about the machine.
+def run_benchmarks(sizes, locations=None, repeat=3, seed=0, startup=True, checks=True):
+    if checks:
+        print("Checking the sample day...", file=sys.stderr)
+    sample_day = check_sample_day() if checks else {}
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for packages in sizes:
+            scenario_locations = locations or max(27, packages // 2)
+            print(f"Benchmarking {packages} packages, {scenario_locations} locations...", file=sys.stderr)
+            results.append(benchmark_scenario(packages, scenario_locations, repeat, seed, folder))
+    if startup:
+        print("Benchmarking startup...", file=sys.stderr)
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.platform(),
+            "seed": seed,
+            "repeat": repeat,
+        },
+        "checks": sample_day,
+        "results": results,
+        "startup": benchmark_startup(repeat) if startup else {},
+    }
+
+# Function to compare two results files. A stage is a regression if its median time grew by more than threshold.
+def compare_results(previous, current, threshold=1.25):
+    old = {(r["packages"], r["locations"], name): timing["median"]
+           for r in previous["results"] for name, timing in r["timings"].items()}
+    regressions = []
+    for result in current["results"]:
+        for name, timing in result["timings"].items():
+            key = (result["packages"], result["locations"], name)
+            if key in old and old[key] > 0:
+                ratio = timing["median"] / old[key]
+                flag = "REGRESSION" if ratio > threshold else ""
+                print(f"{result['packages']:>8} pkgs  {name:<30} {old[key]:10.4f}s -> {timing['median']:10.4f}s  x{ratio:5.2f} {flag}")
+                if ratio > threshold:
+                    regressions.append({"scenario": key[:2], "stage": name, "ratio": ratio})
+    old_startup = previous.get("startup", {})
+    for name, timing in current.get("startup", {}).items():
+        if name in old_startup and old_startup[name]["median"] > 0:
+            ratio = timing["median"] / old_startup[name]["median"]
+            flag = "REGRESSION" if ratio > threshold else ""
+            print(f"{'startup':>13}  {name:<30} {old_startup[name]['median']:10.4f}s -> {timing['median']:10.4f}s  x{ratio:5.2f} {flag}")
+            if ratio > threshold:
+                regressions.append({"scenario": "startup", "stage": name, "ratio": ratio})
+    return regressions
+
+# Function to print a table of the results.
+def print_results(results):
+    if results.get("checks"):
+        print("Sample day checks")
+        for name, check in results["checks"].items():
+            outcome = "ok" if check["passed"] else f"FAILED ({check['error'] or str(check['late']) + ' late'})"
+            print(f"  {name:<30} {outcome}")
+    for result in results["results"]:
+        print(f"\n{result['packages']} packages, {result['locations']} locations ({result['stops']} stops on one route)")
+        for name, timing in result["timings"].items():
+            print(f"  {name:<30} median {timing['median']:10.4f}s   min {timing['min']:10.4f}s")
+    if results.get("startup"):
+        print("\nStartup (sample data)")
+        for name, timing in results["startup"].items():
+            print(f"  {name:<30} median {timing['median']:10.4f}s   min {timing['min']:10.4f}s")
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the routing pipeline on synthetic scenarios")
+    parser.add_argument("--packages", type=int, nargs="+", default=[40, 400, 2000],
+                        help=f"manifest sizes to generate (at least {MIN_PACKAGES})")
+    parser.add_argument("--locations", type=int, default=None,
+                        help="number of locations in the distance table (default: half the packages, at least 27)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per stage")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the generated scenarios")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON results")
+    parser.add_argument("--compare", default=None, help="a previous results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio that counts as a regression when comparing")
+    parser.add_argument("--no-startup", action="store_true", help="skip the startup-time benchmark")
+    parser.add_argument("--no-checks", action="store_true", help="skip the sample day checks")
+    args = parser.parse_args(argv)
+    if min(args.packages) < MIN_PACKAGES:
+        parser.error(f"--packages must be at least {MIN_PACKAGES}")
+
+    results = run_benchmarks(args.packages, args.locations, args.repeat, args.seed, startup=not args.no_startup,
+                             checks=not args.no_checks)
+    print_results(results)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nSaved: {args.output}")
+    failed = [name for name, check in results["checks"].items() if not check["passed"]]
+    if failed:
+        print(f"{len(failed)} sample day check(s) failed: {', '.join(failed)}")
+        return 1
+
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+        print(f"\nCompared with {args.compare}:")
+        regressions = compare_results(previous, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than x{args.threshold}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
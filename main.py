@@ -11,11 +11,53 @@
 # deliveries and provides an interactive console interface to view
 # package statuses and total mileage at any time.
 
+import argparse
+import asyncio
 import csv
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
 from datetime import datetime, timedelta
-from collections import defaultdict
-import matplotlib.pyplot as plt
-from math import cos, sin, pi
+from collections import deque
+from functools import lru_cache, partial
+from heapq import heappush, heappop, heapify
+from contextlib import nullcontext, redirect_stdout
+import numpy as np
+from math import cos, sin, pi, exp
+from bisect import bisect_left, bisect_right
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from urllib.parse import parse_qs, urlsplit
+
+# The start of the delivery day. I parse it once here instead of on every status query.
+DAY_START = datetime.strptime("8:00 AM", "%I:%M %p")
+# The delayed flight lands at 9:05 AM and package 9's correct address is known at 10:20 AM.
+DELAYED_ARRIVAL = datetime.strptime("9:05 AM", "%I:%M %p")
+ADDRESS_CORRECTION_TIME = datetime.strptime("10:20 AM", "%I:%M %p")
+# Corrections for packages whose note says "Wrong address listed", as {package id: (time it is known, address)}.
+# default_events turns each one into a scheduled address change.
+ADDRESS_CORRECTIONS = {9: (ADDRESS_CORRECTION_TIME, "410 S STATE ST")}
+
+# The active Profiler, or None when profiling is off. See enable_profiling().
+PROFILER = None
+
+# matplotlib.pyplot takes most of the program's import time, so it is only imported by load_pyplot()
+# when charts are actually drawn.
+plt = None
+
+# Words that clean_address shortens so package addresses match the distance table.
+ADDRESS_ABBREVIATIONS = {
+    'South': 'S', 'North': 'N', 'East': 'E', 'West': 'W',
+    'Street': 'ST', 'Avenue': 'AVE', 'Blvd': 'BLVD', 'Rd': 'RD'
+}
 
 # Define a class for Package
 class Package:
@@ -26,9 +68,10 @@ class Package:
         self.state = state
         self.zip_code = zip_code
         self.deadline = deadline  # Deadline is stored as a string (e.g., "10:30 AM")
+        self.deadline_minutes = deadline_minutes(deadline)  # Minutes after 8:00 AM, parsed once here.
         self.weight = int(weight)  # I also convert weight to an integer.
         self.notes = notes if notes else ""  # If there are no notes, I store an empty string.
-        self.status = "At the hub"  # Initially, every package is at the hub.
+        self._status = "At the hub"  # Initially, every package is at the hub.
         self.delivery_time = None  # This will be updated when the package is delivered.
         self.delayed_delivery = False  # This flag is set if the package has a delayed requirement.
         self.priority = 0  # Priority can be adjusted later based on notes.
@@ -36,156 +79,1210 @@ class Package:
         self.group_id = None # Used to group packages that must be delivered together.
         self.related_ids = None # Only one package in group seems to dictate what others are in the group, so it will keep track here for handling grouping logic
         self.forced_truck = None # Added to handle special note for packages that must be on truck 2
-        self.hold = False # Used for special case for package 9 where package will not get assigned till after the address is updated
+        self.hold = False # Set when the listed address is wrong; the package is not assigned until it is corrected
         self.original_address = None
         self.address_update_time = None
 
+    # The address is a property so that changing it also clears location_id, the package's row in the
+    # distance matrix. The id is looked up again by location_of the next time it is needed.
+    @property
+    def address(self):
+        return self._address
+
+    @address.setter
+    def address(self, value):
+        self._address = value
+        self.location_id = None
+
+    # A delivered package's status is formatted when it is read, so it does not keep a string of its own.
+    @property
+    def status(self):
+        if self._status is None:
+            return f"Delivered at {self.delivery_time.strftime('%I:%M %p')} (Truck {self.truck_assigned})"
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        self._status = value
+
+    def mark_delivered(self, delivery_time):
+        self.delivery_time = delivery_time
+        self._status = None
+
 # Define a class for Truck
 class Truck:
-    def __init__(self, capacity=16):  # Each truck can carry up to 16 packages per trip.
+    def __init__(self, capacity=16, speed=18, start_time=None):  # Each truck can carry up to 16 packages per trip.
         self.capacity = capacity
+        self.speed = speed  # Average speed in miles per hour, used to turn leg distances into travel time.
         self.packages = []  # This list will store the packages for the current trip.
         self.total_distance = 0.0  # This will accumulate the total distance traveled over all trips.
-        self.current_time = datetime.strptime("08:00 AM", "%I:%M %p") # I set the truck's clock to start at 8:00 AM (the earliest departure time).
+        self.current_time = start_time or DAY_START # I set the truck's clock to start at 8:00 AM (the earliest departure time).
         self.at_hub = True  # Initially, the truck is at the hub.
         self.current_location = "4001 S 700 E"  # This is the hub address.
-        self.trip_history = []  # A list to record the state of each trip.
-        self.routes = [] #list of dicts per trip
+        self.log = None  # The EventLog this truck's trips are written to (see attach_event_log).
+        self.number = None  # The truck's number in the log.
+        self._trip_history = None
+        self._routes = None
         self.baseline_distance = 0.0
+        self.out_of_service = None  # The time the truck broke down, if it did (see LivePlan.break_down).
+
+    # A list to record the state of each trip ({"start_time", "end_time", "packages"}). It is rebuilt from
+    # the event log each time it is read, unless a list has been assigned (see keep_history).
+    @property
+    def trip_history(self):
+        if self._trip_history is not None:
+            return self._trip_history
+        return self.log.trip_history(self.number) if self.log is not None else []
+
+    @trip_history.setter
+    def trip_history(self, value):
+        self._trip_history = value
+
+    # The initial and optimized route of each trip as lists of addresses, rebuilt from the log like trip_history.
+    @property
+    def routes(self):
+        if self._routes is not None:
+            return self._routes
+        return self.log.routes(self.number) if self.log is not None else []
+
+    @routes.setter
+    def routes(self, value):
+        self._routes = value
+
+    # Rebuilds trip_history and routes from the log once and keeps them as lists that can be edited.
+    def keep_history(self):
+        self.trip_history = self.trip_history
+        self.routes = self.routes
+
+# Define a change to the manifest that happens at a known time during the day, such as a delayed package
+# arriving at the hub or a wrong address being corrected. A package with a scheduled event is held at the
+# hub until the event happens.
+class ScheduledEvent:
+    AVAILABLE, ADDRESS_CHANGE = "available", "address_change"
+    __slots__ = ("time", "kind", "package_id", "address")
+
+    def __init__(self, time, kind, package_id, address=None):
+        self.time = time
+        self.kind = kind
+        self.package_id = package_id
+        self.address = address
+
+    def __repr__(self):
+        return f"ScheduledEvent({self.time.strftime('%I:%M %p')}, {self.kind}, package {self.package_id})"
 
 # Define a hash table class for storing packages
+# It uses open addressing with linear probing. The slot table only holds small integers that point into
+# dense key and value lists, so the slots stay compact and iteration follows insertion order.
+# The table doubles in size whenever it becomes more than two-thirds full.
 class HashTable:
-    def __init__(self, size):
-        self.size = size
-        # I initialize the table with a list of None values.
-        self.table = [None] * size
+    __slots__ = ("size", "table", "_keys", "_values")
+
+    EMPTY = -1
+    MAX_LOAD = 2 / 3
+
+    def __init__(self, size=16):
+        self.size = max(int(size), 8)
+        # I initialize the table with empty slots.
+        self.table = [HashTable.EMPTY] * self.size
+        self._keys = []
+        self._values = []
 
     def _hash(self, key):
         # I use the modulo operator to compute the hash index.
-        return key % self.size
+        return hash(key) % self.size
 
-    def insert(self, key, value):
+    def _find_slot(self, key):
+        # I probe forward from the hashed slot until I find the key or an empty slot.
         index = self._hash(key)
-        # If the slot is empty, I create a new list.
-        if not self.table[index]:
-            self.table[index] = []
-        self.table[index].append(value)  # I append the package object.
+        while True:
+            entry = self.table[index]
+            if entry == HashTable.EMPTY or self._keys[entry] == key:
+                return index
+            index = (index + 1) % self.size
+
+    def _resize(self, new_size):
+        self.size = new_size
+        self.table = [HashTable.EMPTY] * new_size
+        for entry, key in enumerate(self._keys):
+            index = self._hash(key)
+            while self.table[index] != HashTable.EMPTY:
+                index = (index + 1) % new_size
+            self.table[index] = entry
+
+    def insert(self, key, value):
+        index = self._find_slot(key)
+        entry = self.table[index]
+        # If the key is already stored, I replace its package object.
+        if entry != HashTable.EMPTY:
+            self._values[entry] = value
+            return
+        self.table[index] = len(self._keys)
+        self._keys.append(key)
+        self._values.append(value)
+        if len(self._keys) > self.size * HashTable.MAX_LOAD:
+            self._resize(self.size * 2)
 
     def search(self, key):
-        index = self._hash(key)
-        # I search the list at the computed index for the package with the matching ID.
-        if self.table[index]:
-            for package in self.table[index]:
-                if package.package_id == key:
-                    return package
+        entry = self.table[self._find_slot(key)]
+        if entry == HashTable.EMPTY:
+            return None
+        return self._values[entry]
+
+    def get_many(self, keys):
+        # I look up a batch of keys at once; missing keys come back as None.
+        return [self.search(key) for key in keys]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return self.table[self._find_slot(key)] != HashTable.EMPTY
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self._keys, self._values))
+
+# Functions that build the properties of PackageView below. Each property reads or writes one column of
+# the view's store at the view's row. Columns use a sentinel value where a Package would hold None.
+def _number_field(column, kind, empty=None):
+    def get(view):
+        value = view._store.columns[column][view._row]
+        return None if empty is not None and value == empty else kind(value)
+
+    def put(view, value):
+        view._store.columns[column][view._row] = empty if value is None else value
+    return property(get, put)
+
+def _text_field(column):
+    def get(view):
+        return view._store.text(view._store.columns[column][view._row])
+
+    def put(view, value):
+        view._store.columns[column][view._row] = view._store.intern(value)
+    return property(get, put)
+
+def _time_field(column):
+    def get(view):
+        return view._store.time(view._store.columns[column][view._row])
+
+    def put(view, value):
+        view._store.columns[column][view._row] = view._store.time_code(value)
+    return property(get, put)
+
+# Define a lightweight view of one package in a ColumnarPackageStore.
+# It has the same attributes as Package, but they live in the store's columns, so a view is only a
+# reference to the store and a row number. Two views of the same row compare equal.
+class PackageView:
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    package_id = _number_field("package_id", int)
+    location_id = _number_field("location_id", int, empty=-1)
+    city = _text_field("city")
+    state = _text_field("state")
+    zip_code = _text_field("zip_code")
+    deadline = _text_field("deadline")
+    deadline_minutes = _number_field("deadline_minutes", float)
+    weight = _number_field("weight", int)
+    notes = _text_field("notes")
+    delivery_time = _time_field("delivery_time")
+    delayed_delivery = _number_field("delayed_delivery", bool)
+    priority = _number_field("priority", int)
+    truck_assigned = _number_field("truck_assigned", int, empty=0)
+    group_id = _number_field("group_id", int, empty=-1)
+    forced_truck = _number_field("forced_truck", int, empty=0)
+    hold = _number_field("hold", bool)
+    original_address = _text_field("original_address")
+    address_update_time = _time_field("address_update_time")
+
+    # Like Package.address, changing the address clears the location id.
+    @property
+    def address(self):
+        return self._store.text(self._store.columns["address"][self._row])
+
+    @address.setter
+    def address(self, value):
+        self._store.columns["address"][self._row] = self._store.intern(value)
+        self._store.columns["location_id"][self._row] = -1
+
+    # The status is kept as a small code and only formatted when it is read.
+    @property
+    def status(self):
+        code = int(self._store.columns["status"][self._row])
+        if code == ColumnarPackageStore.AT_HUB:
+            return "At the hub"
+        if code == ColumnarPackageStore.DELIVERED:
+            return f"Delivered at {self.delivery_time.strftime('%I:%M %p')} (Truck {self.truck_assigned})"
+        return self._store.text(code - ColumnarPackageStore.OTHER_STATUS)
+
+    @status.setter
+    def status(self, value):
+        if value == "At the hub":
+            code = ColumnarPackageStore.AT_HUB
+        elif self.delivery_time is not None and value == self._delivered_status():
+            code = ColumnarPackageStore.DELIVERED
+        else:
+            code = ColumnarPackageStore.OTHER_STATUS + self._store.intern(value)
+        self._store.columns["status"][self._row] = code
+
+    def _delivered_status(self):
+        return f"Delivered at {self.delivery_time.strftime('%I:%M %p')} (Truck {self.truck_assigned})"
+
+    @property
+    def related_ids(self):
+        return self._store.related_ids.get(self._row)
+
+    @related_ids.setter
+    def related_ids(self, value):
+        if value is None:
+            self._store.related_ids.pop(self._row, None)
+        else:
+            self._store.related_ids[self._row] = value
+
+    def mark_delivered(self, delivery_time):
+        self.delivery_time = delivery_time
+        self._store.columns["status"][self._row] = ColumnarPackageStore.DELIVERED
+
+    def __eq__(self, other):
+        return isinstance(other, PackageView) and other._store is self._store and other._row == self._row
+
+    def __hash__(self):
+        return hash((id(self._store), self._row))
+
+    def __repr__(self):
+        return f"PackageView(package {self.package_id})"
+
+# Define a columnar (struct of arrays) package store. It is an alternative to HashTable for large
+# package histories: every package field is one NumPy column instead of an attribute on a Package object,
+# and text fields are codes into one shared list of strings, since cities, addresses and notes repeat on
+# almost every row. It has the same methods as HashTable, but search and values return PackageView
+# objects, so the simulation, menu and display code work with either store.
+# Package ids are found with the same linear probing as HashTable, with the slot table in a NumPy array.
+# Ids are multiplied by a large odd number before taking the slot, because consecutive ids would otherwise
+# fill one long run of slots and every lookup of a missing id would have to probe to the end of it.
+# Whole columns can be read with column() for vectorized queries such as late_packages_per_truck().
+class ColumnarPackageStore:
+    EMPTY = -1
+    MAX_LOAD = 2 / 3
+    # delivery_time and address_update_time are microseconds after DAY_START, with NO_TIME for None.
+    NO_TIME = np.iinfo(np.int64).min
+    # Status codes. Any other status text is stored as OTHER_STATUS plus its string code.
+    AT_HUB, DELIVERED, OTHER_STATUS = 0, 1, 2
+    COLUMNS = {
+        "package_id": np.int64,
+        "location_id": np.int32,
+        "address": np.int32,
+        "city": np.int32,
+        "state": np.int32,
+        "zip_code": np.int32,
+        "deadline": np.int32,
+        "deadline_minutes": np.float64,
+        "weight": np.int32,
+        "notes": np.int32,
+        "status": np.int32,
+        "delivery_time": np.int64,
+        "delayed_delivery": np.bool_,
+        "priority": np.int8,
+        "truck_assigned": np.int16,
+        "group_id": np.int64,
+        "forced_truck": np.int16,
+        "hold": np.bool_,
+        "original_address": np.int32,
+        "address_update_time": np.int64,
+    }
+    # The Package attributes copied by insert, grouped by how they are stored. Number fields map to the
+    # value that stands for None in their column.
+    TEXT_FIELDS = ("address", "city", "state", "zip_code", "deadline", "notes", "original_address")
+    TIME_FIELDS = ("delivery_time", "address_update_time")
+    NUMBER_FIELDS = {"location_id": -1, "deadline_minutes": None, "weight": None, "delayed_delivery": None,
+                     "priority": None, "truck_assigned": 0, "group_id": -1, "forced_truck": 0, "hold": None}
+
+    def __init__(self, size=16):
+        self.size = max(int(size), 8)
+        self.table = np.full(self.size, ColumnarPackageStore.EMPTY, dtype=np.int64)
+        self.count = 0
+        self.columns = {name: np.empty(self.size, dtype=dtype) for name, dtype in ColumnarPackageStore.COLUMNS.items()}
+        self.strings = []
+        self.string_codes = {}
+        # Only grouped packages have related ids, so they are kept by row number instead of in a column.
+        self.related_ids = {}
+
+    # Returns the code of a string, adding it to the shared string list the first time. None is -1.
+    def intern(self, text):
+        if text is None:
+            return -1
+        code = self.string_codes.get(text)
+        if code is None:
+            code = self.string_codes[text] = len(self.strings)
+            self.strings.append(text)
+        return code
+
+    def text(self, code):
+        return None if code < 0 else self.strings[code]
+
+    def time(self, code):
+        return None if code == ColumnarPackageStore.NO_TIME else DAY_START + timedelta(microseconds=int(code))
+
+    def time_code(self, value):
+        return ColumnarPackageStore.NO_TIME if value is None else (value - DAY_START) // timedelta(microseconds=1)
+
+    def _hash(self, key, size):
+        return (hash(key) * 0x9E3779B1) % size
+
+    def _find_slot(self, key):
+        # I probe forward from the hashed slot until I find the key or an empty slot.
+        ids = self.columns["package_id"]
+        index = self._hash(key, self.size)
+        while True:
+            entry = self.table[index]
+            if entry == ColumnarPackageStore.EMPTY or ids[entry] == key:
+                return index
+            index = (index + 1) % self.size
+
+    def _resize(self, new_size):
+        table = [ColumnarPackageStore.EMPTY] * new_size
+        for entry, key in enumerate(self.columns["package_id"][:self.count].tolist()):
+            index = self._hash(key, new_size)
+            while table[index] != ColumnarPackageStore.EMPTY:
+                index = (index + 1) % new_size
+            table[index] = entry
+        self.size = new_size
+        self.table = np.array(table, dtype=np.int64)
+
+    def _grow(self):
+        for name, column in self.columns.items():
+            grown = np.empty(len(column) * 2, dtype=column.dtype)
+            grown[:self.count] = column[:self.count]
+            self.columns[name] = grown
+
+    def insert(self, key, value):
+        index = self._find_slot(key)
+        entry = int(self.table[index])
+        # If the key is already stored, I overwrite its row.
+        if entry == ColumnarPackageStore.EMPTY:
+            if self.count == len(self.columns["package_id"]):
+                self._grow()
+            entry = self.count
+            self.count += 1
+            self.table[index] = entry
+            self.columns["package_id"][entry] = key
+        elif isinstance(value, PackageView) and value._store is self and value._row == entry:
+            return
+        # I write the columns directly instead of through a PackageView, since this runs for every row loaded.
+        columns = self.columns
+        for name in ColumnarPackageStore.TEXT_FIELDS:
+            columns[name][entry] = self.intern(getattr(value, name))
+        for name in ColumnarPackageStore.TIME_FIELDS:
+            columns[name][entry] = self.time_code(getattr(value, name))
+        for name, empty in ColumnarPackageStore.NUMBER_FIELDS.items():
+            number = getattr(value, name)
+            columns[name][entry] = empty if number is None else number
+        if value.related_ids is not None:
+            self.related_ids[entry] = value.related_ids
+        else:
+            self.related_ids.pop(entry, None)
+        # The status is set last because a delivered status is recognized from the delivery time and truck.
+        PackageView(self, entry).status = value.status
+        if self.count > self.size * ColumnarPackageStore.MAX_LOAD:
+            self._resize(self.size * 2)
+
+    def search(self, key):
+        entry = self.table[self._find_slot(key)]
+        if entry == ColumnarPackageStore.EMPTY:
+            return None
+        return PackageView(self, int(entry))
+
+    def get_many(self, keys):
+        # I look up a batch of keys at once; missing keys come back as None.
+        return [self.search(key) for key in keys]
+
+    # Returns a NumPy view of one column for the packages stored so far. The view is not updated
+    # if the store grows afterwards, so it should be read again after inserting.
+    def column(self, name):
+        return self.columns[name][:self.count]
+
+    # Counts the packages each truck delivered after their deadline, as {truck number: count}.
+    def late_packages_per_truck(self):
+        delivered = self.column("delivery_time")
+        on_record = delivered != ColumnarPackageStore.NO_TIME
+        late = on_record & (delivered / 60e6 > self.column("deadline_minutes"))
+        counts = np.bincount(self.column("truck_assigned")[late])
+        return {truck: int(count) for truck, count in enumerate(counts.tolist()) if truck and count}
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self.table[self._find_slot(key)] != ColumnarPackageStore.EMPTY
+
+    def __iter__(self):
+        return iter(self.column("package_id").tolist())
+
+    def keys(self):
+        return self.column("package_id").tolist()
+
+    def values(self):
+        return [PackageView(self, row) for row in range(self.count)]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+# Define a disjoint set (union-find) class for grouping packages that must be delivered together.
+# Each group's root keeps the group's largest package id and any forced truck, so merging two groups is O(1).
+class DisjointSet:
+    __slots__ = ("parent", "size", "largest", "truck")
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+        self.largest = {}
+        self.truck = {}
+
+    def __contains__(self, key):
+        return key in self.parent
+
+    def __iter__(self):
+        return iter(self.parent)
+
+    def add(self, key, forced_truck=None):
+        if key not in self.parent:
+            self.parent[key] = key
+            self.size[key] = 1
+            self.largest[key] = key
+            self.truck[key] = None
+        if forced_truck is not None:
+            self.truck[self.find(key)] = forced_truck
+
+    def find(self, key):
+        # I halve the path on the way up so later lookups are faster.
+        parent = self.parent
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def union(self, key1, key2):
+        self.add(key1)
+        self.add(key2)
+        root1, root2 = self.find(key1), self.find(key2)
+        if root1 == root2:
+            return root1
+        # I attach the smaller group under the larger one.
+        if self.size[root1] < self.size[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        self.size[root1] += self.size.pop(root2)
+        self.largest[root1] = max(self.largest[root1], self.largest.pop(root2))
+        truck = self.truck.pop(root2)
+        if self.truck[root1] is None:
+            self.truck[root1] = truck
+        return root1
+
+    def group_id(self, key):
+        return self.largest[self.find(key)]
+
+    def forced_truck(self, key):
+        return self.truck[self.find(key)]
+
+# Define a queue that decides which packages go on the trucks each delivery cycle.
+# Each package's priority key is computed once. Groups are kept in one heap, packages that can go on any
+# truck in another, and packages forced onto a truck in one heap per truck, so each cycle only looks at
+# the packages it loads instead of re-sorting everything that is left. Held and delayed packages wait in
+# a separate list until they are released. Ties keep manifest order, the same as sorting by priority_score.
+# Packages in held_ids are kept out of the queue until release_package is called for them; a group
+# with a held member is held until all of its held members are released. A package that is delayed or
+# has a wrong address is always held, since only its scheduled event (see default_events) can release it.
+class AssignmentQueue:
+    def __init__(self, packages, held_ids=()):
+        self.groups = []
+        self.free = []
+        self.forced = {}
+        self.held = {}
+        self.held_groups = {}
+        self.count = 0
+        held_ids = set(held_ids)
+        group_members = {}
+        for seq, pkg in enumerate(packages):
+            if pkg.delivery_time is not None:
+                continue
+            self.count += 1
+            key = (priority_score(pkg), seq)
+            if pkg.group_id is not None:
+                group_members.setdefault(pkg.group_id, []).append((key, pkg))
+            elif pkg.package_id in held_ids or pkg.hold or pkg.delayed_delivery:
+                self.held[pkg.package_id] = (key, pkg)
+            else:
+                self._push(key, pkg)
+        # A group is ordered by its highest-priority member, and its members are kept in priority order.
+        for group_id, members in group_members.items():
+            members.sort(key=lambda member: member[0])
+            entry = (members[0][0], group_id, [pkg for _, pkg in members])
+            held_members = {pkg.package_id for _, pkg in members if pkg.package_id in held_ids}
+            if held_members:
+                self.held_groups[group_id] = (entry, held_members)
+                for package_id in held_members:
+                    self.held[package_id] = (None, group_id)
+            else:
+                self.groups.append(entry)
+        heapify(self.groups)
+
+    # Puts a held package (or its group, once every held member is released) into the queue.
+    def release_package(self, package_id):
+        held = self.held.pop(package_id, None)
+        if held is None:
+            return
+        key, item = held
+        if key is not None:
+            self._push(key, item)
+            return
+        entry, held_members = self.held_groups[item]
+        held_members.discard(package_id)
+        if not held_members:
+            del self.held_groups[item]
+            heappush(self.groups, entry)
+
+    def __len__(self):
+        return self.count
+
+    def _push(self, key, pkg):
+        if pkg.forced_truck is not None:
+            heappush(self.forced.setdefault(pkg.forced_truck, []), (key, pkg))
+        else:
+            heappush(self.free, (key, pkg))
+
+    # Loads the trucks for one cycle: groups first, then individual packages in priority order.
+    # If only is given, only the truck at that position is loaded. Packages that can go on any truck fill the
+    # truck that leaves first, so the most urgent packages are not put on a truck that starts later.
+    def assign(self, trucks, only=None):
+        room = [truck.capacity - len(truck.packages) if only is None or t == only else 0
+                for t, truck in enumerate(trucks)]
+        departure_order = sorted(range(len(trucks)), key=lambda t: trucks[t].current_time)
+        skipped = []
+        while self.groups and any(room):
+            entry = heappop(self.groups)
+            group = entry[2]
+            forced_truck = next((p.forced_truck for p in group if p.forced_truck is not None), None)
+            targets = [forced_truck - 1] if forced_truck is not None else departure_order
+            # A group forced onto a truck that isn't in the fleet can never be loaded.
+            if forced_truck is not None and forced_truck > len(trucks):
+                targets = []
+            for t in targets:
+                if len(group) <= room[t]:
+                    self._load(trucks[t], t, group, room)
+                    break
+            else:
+                # If the entire group cannot be assigned in this cycle, it is reattempted in a later cycle.
+                skipped.append(entry)
+        for entry in skipped:
+            heappush(self.groups, entry)
+
+        # Packages forced onto a full truck are simply not looked at; they stay queued for the next cycle.
+        first_open = 0
+        while True:
+            while first_open < len(trucks) and room[departure_order[first_open]] == 0:
+                first_open += 1
+            best = None
+            if first_open < len(trucks) and self.free:
+                best = self.free
+            for number, heap in self.forced.items():
+                if heap and number <= len(trucks) and room[number - 1] > 0 and (best is None or heap[0][0] < best[0][0]):
+                    best = heap
+            if best is None:
+                break
+            _, pkg = heappop(best)
+            t = pkg.forced_truck - 1 if best is not self.free else departure_order[first_open]
+            self._load(trucks[t], t, [pkg], room)
+
+    def _load(self, truck, t, packages, room):
+        for pkg in packages:
+            truck.packages.append(pkg)
+            pkg.truck_assigned = t + 1
+        room[t] -= len(packages)
+        self.count -= len(packages)
+
+# Define a distance matrix class for looking up distances between addresses.
+# It is built once when the distance table is loaded. Addresses are mapped to row numbers with a
+# dictionary so a lookup is O(1), and the lower triangle from the CSV is mirrored into a full
+# symmetric NumPy matrix so any pair of indices can be read directly.
+class DistanceMatrix:
+    def __init__(self, addresses, matrix, missing=()):
+        self.addresses = list(addresses)
+        self.index = {address: i for i, address in enumerate(self.addresses)}
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+        # The (row, column) pairs of the lower triangle that were empty in the CSV. With shortest paths
+        # they hold the length of the shortest detour, otherwise 0.0.
+        self.missing = [tuple(pair) for pair in missing]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def index_of(self, address):
+        try:
+            return self.index[address]
+        except KeyError:
+            # I print a helpful error message if an address lookup fails. It goes to stderr so it never ends
+            # up in the answers of --queries.
+            print(f"Address lookup failed: {address} is not in the distance table", file=sys.stderr)
+            print("Available addresses:", file=sys.stderr)
+            for i, addr in enumerate(self.addresses):
+                print(f"{i}: {addr}", file=sys.stderr)
+            raise ValueError(f"'{address}' is not in the distance table") from None
+
+    def indices_of(self, addresses):
+        return [self.index_of(address) for address in addresses]
+
+    def distance(self, index1, index2):
+        return self.matrix[index1, index2]
+
+    # Builds the matrix from the rows of the CSV, where each row usually only fills the lower triangle.
+    # Empty cells are NaN in rows. A pair only counts as missing when it is empty in both directions.
+    # With shortest_paths=True every distance is replaced by the shortest path
+    # between the two locations (see shortest_path_matrix); otherwise empty cells are read as 0.0.
+    @classmethod
+    def from_lower_triangle(cls, addresses, rows, shortest_paths=True):
+        size = len(addresses)
+        matrix = np.full((size, size), np.nan)
+        for i, row in enumerate(rows[:size]):
+            count = min(len(row), size)
+            matrix[i, :count] = row[:count]
+        np.fill_diagonal(matrix, 0.0)
+        # I mirror the matrix so a distance given in either direction is used for both. If both directions
+        # are given and disagree, the shorter one is kept; fmin ignores a NaN on one side.
+        matrix = np.fmin(matrix, matrix.T)
+        missing = np.argwhere(np.isnan(np.tril(matrix, -1)))
+        if shortest_paths:
+            matrix = shortest_path_matrix(matrix)
+        else:
+            matrix[np.isnan(matrix)] = 0.0
+        return cls(addresses, matrix, missing.tolist())
+
+# Function to turn a distance matrix into the shortest-path distance between every two locations.
+# Unknown distances are NaN. The matrix is made symmetric first: a distance known in only one direction is
+# used for both, and if the two directions disagree the shorter one is kept. Then Floyd-Warshall lets every
+# leg go through another location when that is shorter, one location per step. Each step is a single
+# broadcast of that location's column against its row over the whole matrix.
+# The result obeys the triangle inequality, which the nearest neighbor lists in two_opt_neighbors assume.
+def shortest_path_matrix(matrix):
+    paths = np.array(matrix, dtype=np.float64)
+    paths[np.isnan(paths)] = np.inf
+    paths = np.minimum(paths, paths.T)
+    np.fill_diagonal(paths, 0.0)
+    detour = np.empty_like(paths)
+    for k in range(len(paths)):
+        np.add(paths[:, k, None], paths[k], out=detour)
+        np.minimum(paths, detour, out=paths)
+    if np.isinf(paths).any():
+        i, j = np.argwhere(np.isinf(paths))[0]
+        raise ValueError(f"The distance table has no route between locations {i} and {j}")
+    return paths
+
+# Define a timeline of everything that happened during the simulated day.
+# It is built once after simulate_deliveries finishes. Loads, departures, deliveries, returns and address
+# changes are stored as events sorted by time, so a point-in-time query is a binary search. Every so often
+# the state of all packages is saved as a snapshot, and a query only replays the events after the nearest one.
+class EventTimeline:
+    LOAD, DEPART, DELIVER, RETURN, ADDRESS_CHANGE = range(5)
+
+    def __init__(self, package_hash, trucks):
+        self.packages = package_hash.values()
+        self.position = {pkg.package_id: i for i, pkg in enumerate(self.packages)}
+        # I format the status strings once since they do not change after the simulation.
+        self.delivered_status = [
+            f"Delivered at {pkg.delivery_time.strftime('%I:%M %p')} (Truck {pkg.truck_assigned})" if pkg.delivery_time else None
+            for pkg in self.packages
+        ]
+        self.en_route_status = [f"En route (Truck {pkg.truck_assigned})" for pkg in self.packages]
+        self.start_addresses = [pkg.original_address or pkg.address for pkg in self.packages]
+
+        events = []
+        self.trip_starts = []
+        self.trip_ends = []
+        self.trips = []
+        for truck_number, truck in enumerate(trucks, 1):
+            # trip_history is rebuilt from the event log when it is read, so I read it once.
+            history = truck.trip_history
+            for trip in history:
+                for pkg in trip["packages"]:
+                    events.append((trip["start_time"], EventTimeline.LOAD, truck_number, pkg.package_id, None))
+                events.append((trip["start_time"], EventTimeline.DEPART, truck_number, None, None))
+                events.append((trip["end_time"], EventTimeline.RETURN, truck_number, None, None))
+            # Trips are stored in time order, so I can binary search on their end times.
+            self.trip_starts.append([trip["start_time"] for trip in history])
+            self.trip_ends.append([trip["end_time"] for trip in history])
+            self.trips.append(history)
+        for pkg in self.packages:
+            if pkg.delivery_time is not None:
+                events.append((pkg.delivery_time, EventTimeline.DELIVER, pkg.truck_assigned, pkg.package_id, None))
+            if pkg.address_update_time is not None:
+                events.append((pkg.address_update_time, EventTimeline.ADDRESS_CHANGE, pkg.truck_assigned, pkg.package_id, pkg.address))
+        events.sort(key=lambda event: (event[0], event[1]))
+        self.events = events
+        self.times = [event[0] for event in events]
+
+        # I save a snapshot about once per manifest's worth of events so memory stays proportional to the event count.
+        self.interval = max(256, len(self.packages))
+        self.snapshots = []
+        delivered = array('b', [0] * len(self.packages))
+        addresses = list(self.start_addresses)
+        for k, event in enumerate(events):
+            if k % self.interval == 0:
+                self.snapshots.append((array('b', delivered), list(addresses)))
+            self._apply(event, delivered, addresses)
+
+    def _apply(self, event, delivered, addresses):
+        kind = event[1]
+        if kind == EventTimeline.DELIVER:
+            delivered[self.position[event[3]]] = 1
+        elif kind == EventTimeline.ADDRESS_CHANGE:
+            addresses[self.position[event[3]]] = event[4]
+
+    # Returns which packages are delivered and the address of every package at the query time.
+    def state_at(self, query_time):
+        count = bisect_right(self.times, query_time)
+        if count == 0:
+            return array('b', [0] * len(self.packages)), list(self.start_addresses)
+        snapshot = (count - 1) // self.interval
+        delivered, addresses = self.snapshots[snapshot]
+        delivered, addresses = array('b', delivered), list(addresses)
+        for event in self.events[snapshot * self.interval:count]:
+            self._apply(event, delivered, addresses)
+        return delivered, addresses
+
+    def _status(self, index, delivered, query_time):
+        # The rules match get_status_at.
+        if delivered:
+            return self.delivered_status[index]
+        if query_time <= DAY_START or not self.packages[index].truck_assigned:
+            return "At the hub"
+        return self.en_route_status[index]
+
+    # Returns (package, status, display address) for a single package, or None if it is not in the manifest.
+    def package_at(self, package_id, query_time):
+        index = self.position.get(package_id)
+        if index is None:
+            return None
+        pkg = self.packages[index]
+        delivered = pkg.delivery_time is not None and pkg.delivery_time <= query_time
+        if pkg.address_update_time is not None and query_time < pkg.address_update_time:
+            address = self.start_addresses[index]
+        else:
+            address = pkg.address
+        return pkg, self._status(index, delivered, query_time), address
+
+    # Returns (package, status, display address) for every package at the query time.
+    def packages_at(self, query_time):
+        delivered, addresses = self.state_at(query_time)
+        return [
+            (pkg, self._status(i, delivered[i], query_time), addresses[i])
+            for i, pkg in enumerate(self.packages)
+        ]
+
+    # Returns the trip a truck is on at the query time, or None if it is not out on a trip.
+    def trip_at(self, truck_index, query_time):
+        k = bisect_left(self.trip_ends[truck_index], query_time)
+        if k < len(self.trips[truck_index]) and self.trip_starts[truck_index][k] <= query_time:
+            return self.trips[truck_index][k]
+        return None
+
+# Define an append-only log of everything the trucks did, kept in compact integer columns instead of copied
+# lists. Each entry is (time, truck, package, kind, location): time in microseconds after DAY_START (like
+# ColumnarPackageStore), the truck number, the package id (NO_PACKAGE if the entry is not about a package),
+# what happened, and a location id in the distance matrix. run_truck_trip appends a whole trip at once:
+# LOAD for every package, PLAN for every stop of the nearest neighbor route, DEPART, ARRIVE for every stop
+# of the route that was driven, DELIVER for every package delivered, and RETURN. So a trip is the block of
+# entries after the previous RETURN, and trip loads and routes are rebuilt from it when they are asked for.
+# save() writes the log as a columnar file, each column one after another in a single file, and EventLog.load()
+# memory-maps those columns with np.memmap, so a long history can be queried without reading it into memory.
+class EventLog:
+    LOAD, PLAN, DEPART, ARRIVE, DELIVER, RETURN = range(6)
+    NO_PACKAGE = -1
+    # Column names and their array typecodes.
+    COLUMNS = (("time", "q"), ("truck", "i"), ("package", "i"), ("kind", "b"), ("location", "i"))
+    MAGIC = b"EVENTLOG1\n"
+
+    # addresses is the distance matrix's address list, used to turn routes back into addresses.
+    def __init__(self, addresses=None):
+        self.addresses = addresses
+        self.columns = {name: array(code) for name, code in EventLog.COLUMNS}
+        # Each package that was loaded, by id, so trip loads can be rebuilt as Package objects. A package
+        # is only in here once however many trips it is on.
+        self.packages = {}
+        # {truck number: [(first entry, RETURN entry) for each trip]}. A trip's entries are appended together,
+        # so this index is all that is needed to read one truck's trips without touching the others' entries.
+        self.trip_index = {}
+        # Trips already rebuilt by truck_trips, per truck. Entries are never changed once written, so a
+        # truck's trips are only read from the columns once.
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    # Returns one column as a NumPy array. For a loaded log this is the memory-mapped column itself.
+    def column(self, name):
+        values = self.columns[name]
+        if isinstance(values, np.ndarray):
+            return values
+        return np.array(values, dtype=np.dtype(values.typecode))
+
+    # Appends one trip. The routes are lists of location ids, arrivals has the time the truck reaches each
+    # stop of optimized_route, and delivered lists the packages delivered on the trip.
+    def append_trip(self, truck_number, packages, initial_route, optimized_route, arrivals, delivered, distances):
+        start, end = self.time_code(arrivals[0]), self.time_code(arrivals[-1])
+        rows = [(start, pkg.package_id, EventLog.LOAD, location_of(pkg, distances)) for pkg in packages]
+        rows += [(start, EventLog.NO_PACKAGE, EventLog.PLAN, stop) for stop in initial_route]
+        rows.append((start, EventLog.NO_PACKAGE, EventLog.DEPART, optimized_route[0]))
+        rows += [(self.time_code(arrival), EventLog.NO_PACKAGE, EventLog.ARRIVE, stop)
+                 for stop, arrival in zip(optimized_route[1:-1], arrivals[1:-1])]
+        rows += [(self.time_code(pkg.delivery_time), pkg.package_id, EventLog.DELIVER, location_of(pkg, distances))
+                 for pkg in delivered]
+        rows.append((end, EventLog.NO_PACKAGE, EventLog.RETURN, optimized_route[-1]))
+        self._make_writable()
+        first = len(self)
+        self.trip_index.setdefault(truck_number, []).append((first, first + len(rows) - 1))
+        times, package_ids, kinds, locations = zip(*rows)
+        self.columns["time"].extend(times)
+        self.columns["truck"].extend([truck_number] * len(rows))
+        self.columns["package"].extend(package_ids)
+        self.columns["kind"].extend(kinds)
+        self.columns["location"].extend(locations)
+        for pkg in packages:
+            self.packages.setdefault(pkg.package_id, pkg)
+
+    # A loaded log is read-only memory maps, so the first append copies it into arrays.
+    def _make_writable(self):
+        for name, code in EventLog.COLUMNS:
+            values = self.columns[name]
+            if isinstance(values, np.ndarray):
+                self.columns[name] = array(code, np.ascontiguousarray(values).tobytes())
+
+    @staticmethod
+    def time_code(value):
+        return (value - DAY_START) // timedelta(microseconds=1)
+
+    @staticmethod
+    def time(code):
+        return DAY_START + timedelta(microseconds=int(code))
+
+    # Builds trip_index from the columns, for a log opened with load(). Every trip ends with its RETURN entry.
+    def _index_trips(self):
+        returns = np.flatnonzero(self.column("kind") == EventLog.RETURN)
+        firsts = np.concatenate(([0], returns[:-1] + 1)).astype(np.int64)
+        numbers = self.column("truck")[returns]
+        for number, first, last in zip(numbers.tolist(), firsts.tolist(), returns.tolist()):
+            self.trip_index.setdefault(number, []).append((first, last))
+
+    def trip_count(self, truck_number):
+        return len(self.trip_index.get(truck_number, ()))
+
+    # Returns (start time, end time, package ids loaded, planned route, driven route) for each trip of a truck.
+    # Routes are location ids. Only the entries of this truck's trips are read, and only the first time.
+    def truck_trips(self, truck_number):
+        trips = self.trip_index.get(truck_number, [])
+        decoded = self._decoded.setdefault(truck_number, [])
+        for first, last in trips[len(decoded):]:
+            times, package_ids, kinds, locations = (
+                self.columns[name][first:last + 1].tolist() for name in ("time", "package", "kind", "location"))
+            load = [package_id for package_id, kind in zip(package_ids, kinds) if kind == EventLog.LOAD]
+            planned = [location for location, kind in zip(locations, kinds) if kind == EventLog.PLAN]
+            driven = [location for location, kind in zip(locations, kinds)
+                      if kind in (EventLog.DEPART, EventLog.ARRIVE, EventLog.RETURN)]
+            start = times[kinds.index(EventLog.DEPART)]
+            decoded.append((self.time(start), self.time(times[-1]), load, planned, driven))
+        return list(decoded)
+
+    # Rebuilds a truck's trips in the form of Truck.trip_history. package_hash is needed for a loaded log.
+    def trip_history(self, truck_number, package_hash=None):
+        lookup = package_hash.search if package_hash is not None else self.packages.get
+        return [{"start_time": start, "end_time": end, "packages": [lookup(package_id) for package_id in load]}
+                for start, end, load, _, _ in self.truck_trips(truck_number)]
+
+    # Rebuilds a truck's routes in the form of Truck.routes.
+    def routes(self, truck_number, addresses=None):
+        addresses = addresses or self.addresses
+        return [{"initial_route": [addresses[i] for i in planned], "optimized_route": [addresses[i] for i in driven]}
+                for _, _, _, planned, driven in self.truck_trips(truck_number)]
+
+    # Writes the log to one file: MAGIC, the length of a JSON header, the header (the entry count and each
+    # column's typecode and offset), and then each column's values, starting on 64-byte boundaries.
+    def save(self, filename):
+        count = len(self)
+        layout = []
+        offset = 0
+        for name, code in EventLog.COLUMNS:
+            layout.append([name, code, offset])
+            offset += -(-count * np.dtype(code).itemsize // 64) * 64
+        header = json.dumps({"count": count, "columns": layout}).encode()
+        with open(filename + ".tmp", "wb") as file:
+            file.write(EventLog.MAGIC + len(header).to_bytes(8, "little") + header)
+            data_start = EventLog._data_start(len(header))
+            for (name, code), (_, _, column_offset) in zip(EventLog.COLUMNS, layout):
+                file.seek(data_start + column_offset)
+                file.write(self.column(name).tobytes())
+            file.truncate(data_start + offset)
+        os.replace(filename + ".tmp", filename)
+
+    @staticmethod
+    def _data_start(header_length):
+        return -(-(len(EventLog.MAGIC) + 8 + header_length) // 64) * 64
+
+    # Opens a file written by save(). The columns are memory-mapped, so only the parts a query reads are loaded.
+    @classmethod
+    def load(cls, filename, addresses=None):
+        with open(filename, "rb") as file:
+            if file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{filename} is not an event log")
+            header_length = int.from_bytes(file.read(8), "little")
+            header = json.loads(file.read(header_length))
+        log = cls(addresses)
+        data_start = cls._data_start(header_length)
+        for name, code, offset in header["columns"]:
+            if header["count"]:
+                log.columns[name] = np.memmap(filename, dtype=np.dtype(code), mode="r",
+                                              offset=data_start + offset, shape=(header["count"],))
+            else:
+                log.columns[name] = np.zeros(0, dtype=np.dtype(code))
+        log._index_trips()
+        return log
+
+# This function gives every truck of a fleet the same event log, numbering the trucks from 1. If a truck
+# already has a log (the fleet has been simulated before), that log is kept so the history continues.
+def attach_event_log(trucks, distances):
+    log = next((truck.log for truck in trucks if truck.log is not None), None) or EventLog(distances.addresses)
+    for number, truck in enumerate(trucks, 1):
+        truck.log, truck.number = log, number
+    return log
+
+# Define a profiler that records how long each phase of a run takes, how much memory it peaks at,
+# and counters such as distance lookups and 2-opt moves. It is only created when profiling is turned on.
+# Phases can be entered many times (for example once per delivery cycle) and their totals add up.
+class Profiler:
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self._stack = []
+        tracemalloc.start()
+
+    def phase(self, name):
+        return _ProfilePhase(self, name)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _enter(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        # The enclosing phase keeps the highest peak seen so far before I reset it for this phase.
+        if self._stack:
+            self._stack[-1][3] = max(self._stack[-1][3], peak)
+        tracemalloc.reset_peak()
+        self._stack.append([name, time.perf_counter(), current, current])
+
+    def _exit(self):
+        name, start, start_memory, peak = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if self._stack:
+            self._stack[-1][3] = max(self._stack[-1][3], peak)
+        record = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_memory_bytes": 0, "peak_increase_bytes": 0})
+        record["calls"] += 1
+        record["seconds"] += elapsed
+        record["peak_memory_bytes"] = max(record["peak_memory_bytes"], peak)
+        record["peak_increase_bytes"] = max(record["peak_increase_bytes"], peak - start_memory)
+
+    def report(self):
+        return {
+            "phases": {name: dict(record, seconds=round(record["seconds"], 6)) for name, record in self.phases.items()},
+            "counters": dict(self.counters),
+        }
+
+    def stop(self):
+        tracemalloc.stop()
+
+class _ProfilePhase:
+    __slots__ = ("profiler", "name")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._exit()
+
+_NO_PROFILE = nullcontext()
+
+# Function to time a phase of the run. When profiling is off this returns a shared do-nothing context.
+def profile_phase(name):
+    if PROFILER is None:
+        return _NO_PROFILE
+    return PROFILER.phase(name)
+
+# Function to turn profiling on.
+# The routing and delivery functions read the distance matrix directly instead of calling distance_between,
+# so each one adds the number of matrix entries it read to the "distance_lookups" counter, once per call.
+# The 2-opt and Or-opt searches score their moves from a table copied out of the matrix for the route,
+# and the copy is what they count.
+def enable_profiling():
+    global PROFILER
+    if PROFILER is not None:
+        return PROFILER
+    PROFILER = Profiler()
+    PROFILER.count("distance_lookups", 0)
+    return PROFILER
+
+# Function to turn profiling off and return its report.
+def disable_profiling():
+    global PROFILER
+    if PROFILER is None:
         return None
+    report = PROFILER.report()
+    PROFILER.stop()
+    PROFILER = None
+    return report
 
 # Computes a weighted score for the package based on its deadline and its special priority. Lower scores indicate that the package should be prioritized.
 def priority_score(pkg):
-    base_time = datetime.strptime("08:00 AM", "%I:%M %p")
-    if pkg.deadline.strip().upper() == "EOD":
-        deadline_dt = datetime.strptime("05:00 PM", "%I:%M %p") # Treat end of day as 5PM
-    else:
-        deadline_dt = datetime.strptime(pkg.deadline.strip(), "%I:%M %p")
-    # Compute difference in minutes from 8:00 AM.
-    diff_minutes = (deadline_dt - base_time).total_seconds() / 60
+    # The deadline was already converted to minutes after 8:00 AM when the package was loaded.
+    diff_minutes = pkg.deadline_minutes
     # Let the weight factor be 30 minutes per priority point.
     weight_factor = 30
     score = diff_minutes - (weight_factor * pkg.priority)
     return score
 
-# Function to load package data from CSV
-def load_package_data(filename):
-    # I create a hash table to store packages for fast lookup.
-    package_hash = HashTable(50)
-    # I use a defaultdict to track groups of packages that must be delivered together.
-    grouped_packages = defaultdict(list)
+# Converts a deadline string to minutes after 8:00 AM. Only a few distinct deadlines appear in a manifest,
+# so the parsed values are cached.
+@lru_cache(maxsize=None)
+def deadline_minutes(deadline):
+    if deadline.strip().upper() == "EOD":
+        deadline_dt = datetime.strptime("05:00 PM", "%I:%M %p") # Treat end of day as 5PM
+    else:
+        deadline_dt = datetime.strptime(deadline.strip(), "%I:%M %p")
+    # Compute difference in minutes from 8:00 AM.
+    return (deadline_dt - DAY_START).total_seconds() / 60
 
-    with open(filename, 'r') as file:
+# Function to read the package CSV in chunks.
+# I yield lists of at most chunk_size rows so only one chunk of raw rows is in memory at a time.
+def read_package_rows(filename, chunk_size=10000):
+    with open(filename, 'r', newline='') as file:
         reader = csv.reader(file)
         next(reader)  # I skip the header row.
-
+        chunk = []
         for row in reader:
-            # I create a Package object for each row in the CSV.
-            package = Package(
-                row[0],
-                clean_address(row[1]),  # I clean the address string.
-                row[2],
-                row[3],
-                row[4],
-                row[5],
-                row[6],
-                row[7]
-            )
-
-            # Set package 9 to hold until it's address can be updated and save the original incorrect address
-            if package.package_id == 9:
-                package.hold = True
-                package.original_address = package.address
-
-            # If the note indicates that the package can only be on Truck 2, set forced_truck accordingly
-            if "Can only be on truck 2" in row[7]:
-                package.forced_truck = 2
-
-            # Based on special notes, set package priorities and group packages.
-            if "Must be delivered with" in row[7]:
-                # Remove commas so that numbers like "15," become "15"
-                note_clean = row[7].replace(',', '')
-                # Parse all digits from the cleaned note.
-                package.related_ids = [int(s) for s in note_clean.split() if s.isdigit()]
-                # Use the largest id from the grouped packages as the group id since this will loop over all packages smallest to largest
-                if package.related_ids:
-                    package.group_id = max([package.package_id] + package.related_ids)
-                else:
-                    package.group_id = package.package_id
-                package.priority = 2  # Higher priority for grouped packages.
-            elif "Delayed" in row[7]:
-                package.priority = 1
-                package.delayed_delivery = True
-            elif "EOD" not in row[5]:
-                package.priority = 1
-            else:
-                package.priority = 0
+            if not row:
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
-            package_hash.insert(package.package_id, package)
+# Function to read the truck a package's note says it must go on ("Can only be on truck 2"), or None.
+# This is the only hard truck constraint: forced_truck can also be set while the day is planned.
+def required_truck(notes):
+    match = re.search(r"Can only be on truck (\d+)", notes or "")
+    return int(match.group(1)) if match else None
+
+# Function to build a Package object from one row of the package CSV.
+def package_from_row(row):
+    # I create a Package object for the row.
+    package = Package(
+        row[0],
+        clean_address(row[1]),  # I clean the address string.
+        row[2],
+        row[3],
+        row[4],
+        row[5],
+        row[6],
+        row[7]
+    )
+
+    # Hold a package with a wrong address until it can be updated and save the original incorrect address
+    if "Wrong address listed" in row[7]:
+        package.hold = True
+        package.original_address = package.address
 
-    # Handle grouping logic for packages that are grouped but don't have a note mentioning their grouping
-    all_packages = [package_hash.search(i) for i in range(1, 41)]
-    for pkg in all_packages:
-        # Check if the package has any related_ids.
-        if pkg.related_ids is not None:
-            # Save the original package's group_id.
-            group_id = pkg.group_id
-            
-            # Start with the original package's forced_truck value.
-            forced_truck_value = pkg.forced_truck
-
-            # Loop over each related package id.
-            for related_id in pkg.related_ids:
-                # Use search method to get the related package.
-                related_pkg = package_hash.search(related_id)
-                if related_pkg is not None:
-                    # Set the related package's group_id to match the original package.
-                    related_pkg.group_id = group_id
-                    related_pkg.priority = 2  # Higher priority for grouped packages.
-                    
-                    # If this related package has a forced_truck value, capture it.
-                    if related_pkg.forced_truck is not None:
-                        forced_truck_value = related_pkg.forced_truck
-
-            # If any package in related_ids (or the original package) had forced_truck set,
-            # update the forced_truck property on both the original package and all related packages.
-            if forced_truck_value is not None:
-                pkg.forced_truck = forced_truck_value
-                for related_id in pkg.related_ids:
+    # If the note indicates that the package can only be on one truck, set forced_truck accordingly
+    package.forced_truck = required_truck(row[7])
+
+    # Based on special notes, set package priorities.
+    if "Must be delivered with" in row[7]:
+        # Remove commas so that numbers like "15," become "15"
+        note_clean = row[7].replace(',', '')
+        # Parse all digits from the cleaned note.
+        package.related_ids = [int(s) for s in note_clean.split() if s.isdigit()]
+        package.priority = 2  # Higher priority for grouped packages.
+    elif "Delayed" in row[7]:
+        package.priority = 1
+        package.delayed_delivery = True
+    elif "EOD" not in row[5]:
+        package.priority = 1
+    else:
+        package.priority = 0
+    return package
+
+# Function to load package data from CSV
+# The file is streamed in chunks and "Must be delivered with" notes are merged into groups with a
+# disjoint set as each row is read, so no second pass over the whole manifest is needed.
+# With columnar=True the packages go into a ColumnarPackageStore instead of a HashTable.
+def load_package_data(filename, chunk_size=10000, columnar=False):
+    # I create a hash table to store packages for fast lookup. It grows as packages are added.
+    package_hash = ColumnarPackageStore(50) if columnar else HashTable(50)
+    # I use a disjoint set to track groups of packages that must be delivered together.
+    groups = DisjointSet()
+
+    for chunk in read_package_rows(filename, chunk_size):
+        for row in chunk:
+            package = package_from_row(row)
+            package_hash.insert(package.package_id, package)
+            if package.related_ids is not None:
+                groups.add(package.package_id, package.forced_truck)
+                for related_id in package.related_ids:
+                    # A related package that was already read brings its forced truck into the group.
                     related_pkg = package_hash.search(related_id)
-                    if related_pkg is not None:
-                        related_pkg.forced_truck = forced_truck_value
+                    groups.add(related_id, related_pkg.forced_truck if related_pkg is not None else None)
+                    groups.union(package.package_id, related_id)
+            elif package.forced_truck is not None and package.package_id in groups:
+                # This package was already named in another package's note, so the group picks up its truck.
+                groups.add(package.package_id, package.forced_truck)
+        # The raw rows of this chunk are released before the next one is read.
+        del chunk
+
+    # Each group uses its largest package id as the group id, and a forced truck on any member applies to all.
+    for package_id in groups:
+        pkg = package_hash.search(package_id)
+        if pkg is not None:
+            pkg.group_id = groups.group_id(package_id)
+            pkg.priority = 2  # Higher priority for grouped packages.
+            forced_truck = groups.forced_truck(package_id)
+            if forced_truck is not None:
+                pkg.forced_truck = forced_truck
 
     return package_hash
 
 # Function to load distance and address data from CSV
-def load_distance_data(filename):
+# The parsed matrix is cached in a binary .npy file with the addresses in a JSON sidecar. Later runs
+# memory-map the .npy file instead of parsing the CSV again, as long as the CSV's SHA-256 hash has not changed.
+def load_distance_data(filename, use_cache=True, shortest_paths=True):
+    if use_cache:
+        distances = load_distance_cache(filename, shortest_paths)
+        if distances is not None:
+            check_hub_address(distances.addresses)
+            return distances, distances.addresses
+
     distances = []
     addresses = []
 
@@ -194,14 +1291,8 @@ def load_distance_data(filename):
         headers = next(reader)
         # I assume the first two columns are not addresses; the rest are.
         addresses = [clean_address(header) for header in headers[2:]]
-        hub = "4001 S 700 E"
-        # I verify that the hub address is in the list of addresses.
-        if hub not in addresses:
-            print("Actual cleaned addresses in distance table:")
-            for idx, addr in enumerate(addresses):
-                print(f"{idx}: {addr}")
-            raise ValueError(f"Hub address '{hub}' not found in distance table")
-        # I load the distance values, converting them to floats.
+        check_hub_address(addresses)
+        # I load the distance values, converting them to floats. Empty or unreadable cells are NaN (missing).
         for row in reader:
             row_distances = []
             for cell in row[2:]:
@@ -209,14 +1300,85 @@ def load_distance_data(filename):
                     try:
                         row_distances.append(float(cell.strip()))
                     except ValueError:
-                        row_distances.append(0.0)
+                        row_distances.append(np.nan)
                 else:
-                    row_distances.append(0.0)
+                    row_distances.append(np.nan)
             distances.append(row_distances)
-    
+
+    # I build the distance matrix once here so the rest of the program can look up distances by index.
+    # By default every distance becomes the shortest path, so this is also where missing distances are filled in.
+    distances = DistanceMatrix.from_lower_triangle(addresses, distances, shortest_paths)
+    if distances.missing:
+        filled = "the shortest path through other locations" if shortest_paths else "0.0"
+        print(f"Warning: {len(distances.missing)} distance(s) missing from {filename} were filled in with {filled}:",
+              file=sys.stderr)
+        for i, j in distances.missing[:10]:
+            print(f"  {addresses[i]} - {addresses[j]}", file=sys.stderr)
+    if use_cache:
+        save_distance_cache(filename, distances, shortest_paths)
     return distances, addresses
 
+# Function to verify that the hub address is in the list of addresses.
+def check_hub_address(addresses):
+    hub = "4001 S 700 E"
+    if hub not in addresses:
+        print("Actual cleaned addresses in distance table:", file=sys.stderr)
+        for idx, addr in enumerate(addresses):
+            print(f"{idx}: {addr}", file=sys.stderr)
+        raise ValueError(f"Hub address '{hub}' not found in distance table")
+
+# Function to compute the SHA-256 hash of a file, reading it in blocks.
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to get the paths of the cached matrix and its address sidecar for a distance CSV.
+# The shortest-path matrix and the raw matrix are cached separately.
+def distance_cache_paths(filename, shortest_paths=True):
+    folder, name = os.path.split(os.path.abspath(filename))
+    stem = os.path.splitext(name)[0] + ("" if shortest_paths else ".raw")
+    cache_folder = os.path.join(folder, ".distance_cache")
+    return os.path.join(cache_folder, f"{stem}.npy"), os.path.join(cache_folder, f"{stem}.json")
+
+# Function to load a cached distance matrix. It returns None if there is no cache or the CSV has changed.
+def load_distance_cache(filename, shortest_paths=True):
+    matrix_path, index_path = distance_cache_paths(filename, shortest_paths)
+    try:
+        with open(index_path, 'r') as file:
+            index = json.load(file)
+        if index.get("sha256") != file_hash(filename) or index.get("shortest_paths") != shortest_paths:
+            return None
+        # I memory-map the matrix so opening it doesn't read the whole file.
+        matrix = np.load(matrix_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if matrix.shape != (len(index["addresses"]),) * 2:
+        return None
+    return DistanceMatrix(index["addresses"], matrix, index["missing"])
+
+# Function to save a distance matrix to the cache next to its CSV.
+# The sidecar is written last, so a cache is only used once both files are complete.
+def save_distance_cache(filename, distances, shortest_paths=True):
+    matrix_path, index_path = distance_cache_paths(filename, shortest_paths)
+    try:
+        os.makedirs(os.path.dirname(matrix_path), exist_ok=True)
+        with open(matrix_path + ".tmp", 'wb') as file:
+            np.save(file, distances.matrix)
+        os.replace(matrix_path + ".tmp", matrix_path)
+        with open(index_path + ".tmp", 'w') as file:
+            json.dump({"sha256": file_hash(filename), "addresses": distances.addresses,
+                       "shortest_paths": shortest_paths, "missing": distances.missing}, file)
+        os.replace(index_path + ".tmp", index_path)
+    except OSError as e:
+        # The cache is only a speedup, so I keep going without it.
+        print(f"Could not write distance cache: {e}", file=sys.stderr)
+
 # Function to clean an address string
+# Manifests repeat the same few addresses many times, so each raw string is only cleaned once.
+@lru_cache(maxsize=65536)
 def clean_address(raw_address):
     # I check for the hub address first.
     if "4001 South 700 East" in raw_address:
@@ -226,33 +1388,27 @@ def clean_address(raw_address):
         return "300 STATE ST"
     # I extract the actual address by splitting the string.
     address = raw_address.split('\n')[-1].split(',')[0].strip()
-    # I use a dictionary to replace full words with abbreviations.
-    replacements = {
-        'South': 'S', 'North': 'N', 'East': 'E', 'West': 'W',
-        'Street': 'ST', 'Avenue': 'AVE', 'Blvd': 'BLVD', 'Rd': 'RD'
-    }
-    for full, abbrev in replacements.items():
+    # I replace full words with abbreviations.
+    for full, abbrev in ADDRESS_ABBREVIATIONS.items():
         address = address.replace(full, abbrev)
     return address.upper()
 
-# Function to calculate distance between two addresses using the triangular matrix
+# Function to get the location id of a package: the row of its address in the distance matrix.
+# The id is stored on the package the first time, so routing and delivery work on integers from then on.
+def location_of(pkg, distances):
+    if pkg.location_id is None:
+        pkg.location_id = distances.index_of(clean_address(pkg.address))
+    return pkg.location_id
+
+# Function to give every package its location id as soon as the distance table is loaded.
+def assign_location_ids(packages, distances):
+    for pkg in packages:
+        location_of(pkg, distances)
+
+# Function to calculate distance between two addresses using the distance matrix
 def distance_between(address1, address2, addresses, distances):
-    try:
-        index1 = addresses.index(address1)
-        index2 = addresses.index(address2)
-    except ValueError as e:
-        # I print a helpful error message if an address lookup fails.
-        print(f"Address lookup failed: {e}")
-        print(f"Address1: {address1}")
-        print(f"Address2: {address2}")
-        print("Available addresses:")
-        for i, addr in enumerate(addresses):
-            print(f"{i}: {addr}")
-        raise
-    # I use the lower triangle of the matrix.
-    i = min(index1, index2)
-    j = max(index1, index2)
-    return distances[j][i]
+    # I look up both row numbers in the matrix's address index instead of scanning the address list.
+    return distances.distance(distances.index_of(address1), distances.index_of(address2))
 
 # Function to find the nearest address using a greedy approach
 def min_distance_from(current_address, unvisited_addresses, addresses, distances):
@@ -260,12 +1416,14 @@ def min_distance_from(current_address, unvisited_addresses, addresses, distances
         return None
     nearest_address = None
     shortest_distance = float('inf')
+    row = distances.matrix[distances.index_of(current_address)]
     # I iterate over all unvisited addresses and pick the one with the smallest distance.
     for address in unvisited_addresses:
-        if address not in addresses:
-            print(f"Warning: Address {address} not found in address list")
+        index = distances.index.get(address)
+        if index is None:
+            print(f"Warning: Address {address} not found in address list", file=sys.stderr)
             continue
-        dist = distance_between(current_address, address, addresses, distances)
+        dist = row[index]
         if dist < shortest_distance:
             shortest_distance = dist
             nearest_address = address
@@ -273,7 +1431,7 @@ def min_distance_from(current_address, unvisited_addresses, addresses, distances
 
 # Gets status of a specific package at a specific time
 def get_status_at(pkg, query_time):
-    base_start = datetime.strptime("8:00 AM", "%I:%M %p")
+    base_start = DAY_START
     # If the package has been delivered and the delivery time is less than or equal to query_time:
     if pkg.delivery_time and pkg.delivery_time <= query_time:
         return f"Delivered at {pkg.delivery_time.strftime('%I:%M %p')} (Truck {pkg.truck_assigned})"
@@ -286,7 +1444,7 @@ def get_status_at(pkg, query_time):
         return "At the hub"
     
 def get_display_address(pkg, query_time):
-    if pkg.package_id == 9 and pkg.address_update_time is not None and query_time < pkg.address_update_time:
+    if pkg.original_address is not None and pkg.address_update_time is not None and query_time < pkg.address_update_time:
         return pkg.original_address
     return pkg.address
 
@@ -295,8 +1453,7 @@ def get_display_address(pkg, query_time):
 def display_package_status(package_hash, query_time=None):
     if query_time is None:
         query_time = datetime.now()
-    for package_id in range(1, 41):
-        pkg = package_hash.search(package_id)
+    for pkg in package_hash.values():
         status = get_status_at(pkg, query_time)
         print(f"Package ID: {pkg.package_id}          Delivery Status: {status}          Delivery Deadline: {pkg.deadline}          Delivery Address: {pkg.address}          Truck Number: {pkg.truck_assigned}")
 
@@ -309,38 +1466,702 @@ def display_total_mileage(trucks):
 
 # This function computes the total distance of a given route.
 def route_distance(route, addresses, distances):
+    return route_index_distance(distances.indices_of(route), distances)
+
+# This function computes the total distance of a route given as matrix indices.
+def route_index_distance(route, distances):
+    matrix = distances.matrix
     total = 0
     for i in range(len(route) - 1):
-        total += distance_between(route[i], route[i+1], addresses, distances)
+        total += matrix[route[i], route[i+1]]
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", max(len(route) - 1, 0))
     return total
 
 # The two_opt function tries to improve the route by reversing segments.
 def two_opt(route, addresses, distances):
-    best_route = route
-    best_distance = route_distance(best_route, addresses, distances)
+    return [distances.addresses[i] for i in two_opt_indices(distances.indices_of(route), distances)]
+
+# The exhaustive 2-opt on a route of location ids, so every candidate is scored without address lookups.
+def two_opt_indices(route, distances):
+    best_route = list(route)
+    best_distance = route_index_distance(best_route, distances)
     improved = True
+    passes = moves = 0
     # I keep trying to improve the route until no further improvement is found.
     while improved:
         improved = False
+        passes += 1
         for i in range(1, len(best_route) - 2):
             for j in range(i+1, len(best_route) - 1):
                 new_route = best_route[:i] + best_route[i:j+1][::-1] + best_route[j+1:]
-                new_distance = route_distance(new_route, addresses, distances)
+                new_distance = route_index_distance(new_route, distances)
                 if new_distance < best_distance:
                     best_route = new_route
                     best_distance = new_distance
                     improved = True
-        route = best_route
+                    moves += 1
+    if PROFILER is not None:
+        PROFILER.count("two_opt_passes", passes)
+        PROFILER.count("two_opt_moves", moves)
+    return best_route
+
+# This function finds the nearest neighbors of every stop on a route, closest first.
+# The lists only include stops that are on the same route since those are the only candidate moves.
+def route_neighbor_lists(stops, distances, neighbor_count):
+    sub_matrix = distances.matrix[np.ix_(stops, stops)]
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", sub_matrix.size)
+    # I set the diagonal to infinity so a stop is never its own neighbor.
+    np.fill_diagonal(sub_matrix, np.inf)
+    count = min(neighbor_count, len(stops) - 1)
+    nearest = np.argsort(sub_matrix, axis=1, kind="stable")[:, :count]
+    return nearest.tolist()
+
+# A faster 2-opt that scores each move by the four edges it changes instead of recomputing the whole route.
+# Candidate moves are limited to each stop's nearest neighbors, segments are reversed in place, and
+# "don't-look bits" skip stops whose surroundings have not changed since they last failed to improve.
+def two_opt_neighbors(route, addresses, distances, neighbor_count=8):
+    optimized = two_opt_neighbor_indices(distances.indices_of(route), distances, neighbor_count)
+    return [distances.addresses[i] for i in optimized]
+
+# two_opt_neighbors on a route of location ids. The simulation keeps its routes as ids, so this is the one it calls.
+def two_opt_neighbor_indices(route, distances, neighbor_count=8):
+    # I work on local stop numbers 0..m-1 where 0 is the hub at both ends of the route.
+    stops = route[:-1]
+    m = len(stops)
+    # Routes with fewer than 2 movable stops or repeated stops are left to the exhaustive two_opt.
+    if m < 4 or len(set(stops)) != m or route[0] != route[-1]:
+        return two_opt_indices(route, distances)
+    dist = distances.matrix[np.ix_(stops, stops)].tolist()
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", m * m)
+    neighbors = route_neighbor_lists(stops, distances, neighbor_count)
+    # tour holds local stop numbers with the hub at both ends.
+    tour = list(range(m)) + [0]
+    looks, moves = _two_opt_neighbor_search(tour, dist, neighbors)
+    if PROFILER is not None:
+        PROFILER.count("two_opt_passes")
+        PROFILER.count("two_opt_stops_examined", looks)
+        PROFILER.count("two_opt_moves", moves)
+    return [stops[k] for k in tour]
+
+# The search loop of two_opt_neighbors. It improves tour (local stop numbers, hub 0 at both ends) in place
+# and returns how many stops it looked at and how many moves it made. If out_of_time is given, it is checked
+# before every look and the search stops as soon as it returns True. If windows (a RouteTimeWindows) is
+# given, moves it does not allow are skipped.
+def _two_opt_neighbor_search(tour, dist, neighbors, out_of_time=None, windows=None):
+    m = len(tour) - 1
+    # position maps a stop to its index in tour.
+    position = [0] * m
+    for k in range(m):
+        position[tour[k]] = k
+    last = m
+    queue = deque(range(m))
+    queued = [True] * m
+    # I only count in the branch that applies a move, so the search loop itself has no profiling cost.
+    looks = m
+    moves = 0
+
+    def reverse(lo, hi):
+        tour[lo:hi+1] = tour[lo:hi+1][::-1]
+        for k in range(lo, hi + 1):
+            position[tour[k]] = k
+
+    while queue:
+        if out_of_time is not None and out_of_time():
+            break
+        a = queue.popleft()
+        queued[a] = False
+        move = None
+        # First I try replacing the edge from a to the stop after it.
+        i = position[a]
+        b = tour[i+1]
+        d_ab = dist[a][b]
+        for c in neighbors[a]:
+            gain = d_ab - dist[a][c]
+            if gain <= 0:
+                break
+            j = position[c]
+            d = tour[j+1]
+            delta = dist[b][d] - dist[c][d] - gain
+            if delta < -1e-9 and (windows is None or windows.allows(min(i, j) + 1, max(i, j))):
+                move = (min(i, j) + 1, max(i, j), (a, b, c, d))
+                break
+        # Then I try replacing the edge from the stop before a to a.
+        if move is None:
+            i = last if a == 0 else position[a]
+            p = tour[i-1]
+            d_pa = dist[p][a]
+            for c in neighbors[a]:
+                gain = d_pa - dist[a][c]
+                if gain <= 0:
+                    break
+                j = last if c == 0 else position[c]
+                q = tour[j-1]
+                delta = dist[p][q] - dist[q][c] - gain
+                if delta < -1e-9 and (windows is None or windows.allows(min(i, j), max(i, j) - 1)):
+                    move = (min(i, j), max(i, j) - 1, (a, p, c, q))
+                    break
+        if move is None:
+            continue
+        lo, hi, endpoints = move
+        reverse(lo, hi)
+        if windows is not None:
+            windows.refresh()
+        moves += 1
+        # The stops at both ends of the changed edges get another look.
+        for stop in endpoints:
+            if not queued[stop]:
+                queued[stop] = True
+                queue.append(stop)
+                looks += 1
+    return looks, moves
+
+# This function applies a random "double bridge" kick to a route: the stops between the hubs are cut into
+# four pieces A B C D and put back together as A C B D. 2-opt cannot undo this move in one step, so it
+# sends the search to a different local optimum.
+def double_bridge(route, rng):
+    stops = route[1:-1]
+    if len(stops) < 8:
+        shuffled = stops[:]
+        rng.shuffle(shuffled)
+        return [route[0]] + shuffled + [route[-1]]
+    i, j, k = sorted(rng.sample(range(1, len(stops)), 3))
+    return [route[0]] + stops[:i] + stops[j:k] + stops[i:j] + stops[k:] + [route[-1]]
+
+# This function runs 2-opt from several starting routes and keeps the shortest result.
+# The first start is the route as given, so starts=1 gives the same result as two_opt_neighbors.
+def multi_start_two_opt(route, addresses, distances, starts=1, seed=0):
+    optimized = multi_start_two_opt_indices(distances.indices_of(route), distances, starts, seed)
+    return [distances.addresses[i] for i in optimized]
+
+# multi_start_two_opt on a route of location ids.
+def multi_start_two_opt_indices(route, distances, starts=1, seed=0):
+    rng = random.Random(seed)
+    best_route = two_opt_neighbor_indices(route, distances)
+    best_distance = route_index_distance(best_route, distances)
+    for _ in range(starts - 1):
+        candidate = two_opt_neighbor_indices(double_bridge(best_route, rng), distances)
+        candidate_distance = route_index_distance(candidate, distances)
+        if candidate_distance < best_distance - 1e-9:
+            best_route, best_distance = candidate, candidate_distance
     return best_route
 
+# Functions and a class for deadline-aware 2-opt below. The 2-opt functions above only look at miles, so a
+# move can make a package late without anything noticing until the route is driven.
+
+# Define the deadlines of one route for the deadline-aware 2-opt. Time is counted in miles driven since the
+# truck left the hub, so latest[s] is how far the truck can drive before it has to reach local stop s
+# (infinity for the hub). refresh() works out, for the current tour, the miles driven when each position is
+# reached (the forward arrival times), the smallest slack from each position to the end of the route, and a
+# sparse table of range minimums. With those, allows() checks a 2-opt move against every deadline in
+# constant time. refresh() has to be called after each move that is made.
+class RouteTimeWindows:
+    def __init__(self, tour, dist, sub_matrix, latest):
+        self.tour = tour
+        self.dist = dist
+        self.sub_matrix = sub_matrix
+        self.latest = np.asarray(latest, dtype=np.float64)
+        self.rejected = 0
+        self.refresh()
+
+    def refresh(self):
+        order = np.asarray(self.tour, dtype=np.intp)
+        self.arrival = np.concatenate(([0.0], np.cumsum(self.sub_matrix[order[:-1], order[1:]])))
+        latest = self.latest[order]
+        # slack_after[k] is how much later every stop from position k on could be reached and still be on time.
+        self.slack_after = np.minimum.accumulate((latest - self.arrival)[::-1])[::-1]
+        # levels[b][k] is the smallest latest + arrival over the 2**b positions starting at k.
+        self.levels = [latest + self.arrival]
+        width = 1
+        while 2 * width <= len(order):
+            previous = self.levels[-1]
+            self.levels.append(np.minimum(previous[:-width], previous[width:]))
+            width *= 2
+
+    # Checks the move that reverses tour[lo..hi] (with 1 <= lo <= hi < len(tour) - 1).
+    def allows(self, lo, hi):
+        tour, dist = self.tour, self.dist
+        before, first, last, after = tour[lo-1], tour[lo], tour[hi], tour[hi+1]
+        # After the move the segment is driven backwards, so the stop at position q is reached at
+        # reach - arrival[q]. That is on time for every q when reach <= min(latest[q] + arrival[q]).
+        reach = self.arrival[lo-1] + dist[before][last] + self.arrival[hi]
+        level = (hi - lo + 1).bit_length() - 1
+        row = self.levels[level]
+        if reach > min(row[lo], row[hi - (1 << level) + 1]) + 1e-9:
+            self.rejected += 1
+            return False
+        # Every stop after the segment is reached earlier or later by the change in the route's length.
+        change = dist[before][last] + dist[first][after] - dist[before][first] - dist[last][after]
+        if change > self.slack_after[hi+1] + 1e-9:
+            self.rejected += 1
+            return False
+        return True
+
+# This function works out how many miles a truck leaving the hub at start_time can drive before it has to
+# reach each stop, from the earliest deadline of the packages for that stop. Returns {location id: miles}.
+def route_latest_miles(packages, start_time, speed, distances):
+    start_minutes = (start_time - DAY_START).total_seconds() / 60
+    latest = {}
+    for stop, stop_packages in build_stop_index(packages, distances).items():
+        earliest = min(pkg.deadline_minutes for pkg in stop_packages)
+        latest[stop] = (earliest - start_minutes) / 60 * speed
+    return latest
+
+# This function returns the stops of a route of location ids that are reached after their latest miles.
+def late_stops(route, latest, distances):
+    stops = np.asarray(route, dtype=np.intp)
+    reached = np.cumsum(distances.matrix[stops[:-1], stops[1:]]).tolist()
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", len(reached))
+    return [stop for stop, miles in zip(route[1:-1], reached) if miles > latest.get(stop, np.inf) + 1e-9]
+
+# This function builds a route that visits the stops with the earliest deadlines first. Stops with the same
+# deadline are visited in nearest neighbor order.
+def deadline_first_indices(route, latest, distances):
+    groups = {}
+    for stop in route[1:-1]:
+        groups.setdefault(latest.get(stop, np.inf), []).append(stop)
+    ordered = [route[0]]
+    for limit in sorted(groups):
+        ordered.extend(nearest_neighbor_indices(ordered[-1], groups[limit], distances)[1:-1])
+    return ordered + [route[-1]]
+
+# The deadline-aware version of two_opt_neighbor_indices, for a truck that is about to leave the hub with its
+# load. It starts from route (the nearest neighbor route), or from deadline_first_indices if that one misses
+# fewer deadlines, and then only makes the 2-opt moves that RouteTimeWindows allows, so an on-time route stays
+# on time. A stop that is late in the starting route anyway may not get any later.
+# Keeping every step on time can also stop the search short of a shorter route that is on time, so the plain
+# two_opt_neighbor_indices route is returned instead when it is shorter and misses no more deadlines.
+def on_time_route_indices(route, truck, distances, neighbor_count=8):
+    nearest_route = route
+    latest = route_latest_miles(truck.packages, truck.current_time, truck.speed, distances)
+    late = late_stops(route, latest, distances)
+    if late:
+        fallback = deadline_first_indices(route, latest, distances)
+        if len(late_stops(fallback, latest, distances)) < len(late):
+            route = fallback
+    stops = route[:-1]
+    m = len(stops)
+    # Two stops are not worth a search, and routes that repeat a stop are left as they are.
+    if m < 4 or len(set(stops)) != m or route[0] != route[-1]:
+        return route
+    sub_matrix = distances.matrix[np.ix_(stops, stops)]
+    dist = sub_matrix.tolist()
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", m * m)
+    neighbors = route_neighbor_lists(stops, distances, neighbor_count)
+    tour = list(range(m)) + [0]
+    windows = RouteTimeWindows(tour, dist, sub_matrix, [np.inf] + [latest.get(stop, np.inf) for stop in stops[1:]])
+    if late:
+        # The starting tour is the identity, so position k is local stop k here.
+        windows.latest = np.maximum(windows.latest, windows.arrival[:m])
+        windows.refresh()
+    looks, moves = _two_opt_neighbor_search(tour, dist, neighbors, windows=windows)
+    if PROFILER is not None:
+        PROFILER.count("two_opt_passes")
+        PROFILER.count("two_opt_stops_examined", looks)
+        PROFILER.count("two_opt_moves", moves)
+        PROFILER.count("deadline_rejections", windows.rejected)
+    on_time_route = [stops[k] for k in tour]
+    shortest = two_opt_neighbor_indices(nearest_route, distances, neighbor_count)
+    if (len(late_stops(shortest, latest, distances)) <= len(late_stops(on_time_route, latest, distances))
+            and route_index_distance(shortest, distances) < route_index_distance(on_time_route, distances) - 1e-9):
+        return shortest
+    return on_time_route
+
+# This function returns the delivered packages that arrived after their deadline, in package id order.
+def missed_deadlines(package_hash):
+    late = [pkg for pkg in package_hash.values()
+            if pkg.delivery_time is not None
+            and (pkg.delivery_time - DAY_START).total_seconds() / 60 > pkg.deadline_minutes]
+    return sorted(late, key=lambda pkg: pkg.package_id)
+
+# This function returns the ids of packages whose trip left the hub before they were ready, in id order.
+# ready_at maps a package id to the time it arrived or its address was corrected (see default_events).
+def early_departures(trucks, ready_at):
+    early = set()
+    for truck in trucks:
+        for trip in truck.trip_history:
+            for pkg in trip["packages"]:
+                if pkg.package_id in ready_at and trip["start_time"] < ready_at[pkg.package_id]:
+                    early.add(pkg.package_id)
+    return sorted(early)
+
+# Functions for the anytime optimizer below. It works with a wall-clock budget per route instead of running
+# until no move is left: it always holds a complete route, keeps the best one found so far and returns it as
+# soon as the budget runs out or it is told to stop.
+
+# This function prepares the local distance rows and nearest neighbor lists for a route's stops, like
+# two_opt_neighbors does, but a block of rows at a time so a long route can still stop when time runs out.
+# Returns None if it ran out of time.
+def _anytime_tables(stops, distances, neighbor_count, out_of_time, block=64):
+    dist = []
+    neighbors = []
+    count = min(neighbor_count, len(stops) - 1)
+    for start in range(0, len(stops), block):
+        if out_of_time():
+            return None
+        rows = distances.matrix[np.ix_(stops[start:start+block], stops)]
+        if PROFILER is not None:
+            PROFILER.count("distance_lookups", rows.size)
+        dist.extend(rows.tolist())
+        # I set each stop's own column to infinity so a stop is never its own neighbor.
+        rows[np.arange(len(rows)), np.arange(start, start + len(rows))] = np.inf
+        nearest = np.argpartition(rows, count - 1, axis=1)[:, :count]
+        order = np.argsort(np.take_along_axis(rows, nearest, axis=1), axis=1, kind="stable")
+        neighbors.extend(np.take_along_axis(nearest, order, axis=1).tolist())
+    return dist, neighbors
+
+# One pass of Or-opt over tour (local stop numbers, hub 0 at both ends): every segment of 1, 2 or 3 stops
+# is tried next to the nearest neighbors of its end stops, in both directions, and moved to the place that
+# saves the most miles. Returns the number of moves made.
+def _or_opt_pass(tour, dist, neighbors, out_of_time):
+    m = len(tour) - 1
+    position = [0] * m
+    for k in range(m):
+        position[tour[k]] = k
+    moves = 0
+    for length in (1, 2, 3):
+        i = 1
+        while i + length <= m:
+            if out_of_time():
+                return moves
+            first, last = tour[i], tour[i+length-1]
+            p, n = tour[i-1], tour[i+length]
+            removed = dist[p][first] + dist[last][n] - dist[p][n]
+            best = None
+            for c in neighbors[first] + neighbors[last]:
+                # Edge e joins tour[e] and tour[e+1]. The hub's edges are the first and the last one.
+                j = position[c]
+                for e in ((j - 1, j) if c else (0, m - 1)):
+                    # The edges touching the segment itself are not places to move it to.
+                    if e < 0 or i - 1 <= e <= i + length - 1:
+                        continue
+                    a, b = tour[e], tour[e+1]
+                    forward = dist[a][first] + dist[last][b] - dist[a][b]
+                    backward = dist[a][last] + dist[first][b] - dist[a][b]
+                    gain = removed - min(forward, backward)
+                    if gain > 1e-9 and (best is None or gain > best[0]):
+                        best = (gain, e, backward < forward)
+            if best is None:
+                i += 1
+                continue
+            _, e, reverse = best
+            segment = tour[i:i+length]
+            if reverse:
+                segment.reverse()
+            del tour[i:i+length]
+            if e > i:
+                e -= length
+            tour[e+1:e+1] = segment
+            for k in range(min(i, e + 1), max(i, e + 1) + length):
+                position[tour[k]] = k
+            moves += 1
+    return moves
+
+# Runs 2-opt and Or-opt in turn until neither finds a move or time runs out, and returns the tour's length.
+def _anytime_local_search(tour, dist, neighbors, out_of_time):
+    while not out_of_time():
+        _, two_opt_moves = _two_opt_neighbor_search(tour, dist, neighbors, out_of_time)
+        or_opt_moves = _or_opt_pass(tour, dist, neighbors, out_of_time)
+        if PROFILER is not None:
+            PROFILER.count("two_opt_moves", two_opt_moves)
+            PROFILER.count("or_opt_moves", or_opt_moves)
+        # The 2-opt search only ends early when time is up, so a pass without Or-opt moves is a local optimum.
+        if not or_opt_moves:
+            break
+    return sum(dist[tour[k]][tour[k+1]] for k in range(len(tour) - 1))
+
+# The anytime optimizer for one route of location ids that starts and ends at the hub.
+# budget is in seconds (None means no limit) and stop_event is a threading.Event that ends the search early.
+# With perturb=True the time left after the first local optimum goes to a perturbation loop: the current route
+# gets a double bridge kick and a new local search, and the result replaces the current route if it is shorter,
+# or, with a chance that shrinks as the budget runs out, even if it is a little longer (simulated annealing).
+# The shortest route seen is the one returned. perturb needs a budget, since the loop only ends when time is up.
+def anytime_optimize_indices(route, distances, budget=None, perturb=False, seed=0, stop_event=None, neighbor_count=8):
+    started = time.perf_counter()
+    deadline = None if budget is None else started + budget
+
+    def out_of_time():
+        return ((deadline is not None and time.perf_counter() >= deadline)
+                or (stop_event is not None and stop_event.is_set()))
+
+    stops = route[:-1]
+    m = len(stops)
+    # Like two_opt_neighbors, routes that are too short or repeat a stop go to the exhaustive two_opt.
+    if m < 4 or len(set(stops)) != m or route[0] != route[-1]:
+        return two_opt_indices(route, distances)
+    tables = _anytime_tables(stops, distances, neighbor_count, out_of_time)
+    if tables is None:
+        return list(route)
+    dist, neighbors = tables
+    current = list(range(m)) + [0]
+    current_length = _anytime_local_search(current, dist, neighbors, out_of_time)
+    best, best_length = current[:], current_length
+    if perturb and deadline is not None:
+        rng = random.Random(seed)
+        # The starting temperature is a fraction of an average leg, so only small steps back are taken.
+        start_temperature = 0.1 * current_length / m
+        kicks = 0
+        while not out_of_time():
+            candidate = double_bridge(current, rng)
+            candidate_length = _anytime_local_search(candidate, dist, neighbors, out_of_time)
+            kicks += 1
+            temperature = start_temperature * max(0.0, 1 - (time.perf_counter() - started) / budget)
+            worse_by = candidate_length - current_length
+            if worse_by < 0 or (temperature > 0 and rng.random() < exp(-worse_by / temperature)):
+                current, current_length = candidate, candidate_length
+                if current_length < best_length - 1e-9:
+                    best, best_length = current[:], current_length
+        if PROFILER is not None:
+            PROFILER.count("perturbation_kicks", kicks)
+    return [stops[k] for k in best]
+
+# Define an optimizer that runs the anytime optimizer on each route in this process.
+# It has the same optimize(routes) method as ParallelRouteOptimizer, so the simulations can use either one.
+# stop() ends the search on the current route and on any later ones right away, each returning its best so far.
+class AnytimeRouteOptimizer:
+    def __init__(self, distances, budget, perturb=False, seed=0):
+        self.distances = distances
+        self.budget = budget
+        self.perturb = perturb
+        self.seed = seed
+        self.stop_event = threading.Event()
+
+    def optimize(self, routes):
+        return [
+            anytime_optimize_indices(route, self.distances, self.budget, self.perturb, self.seed + i, self.stop_event)
+            for i, route in enumerate(routes)
+        ]
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Each worker process keeps its own view of the shared distance matrix in these globals.
+_worker_memory = None
+_worker_distances = None
+
+# This function copies a distance matrix into a new shared memory block for a pool of worker processes and
+# returns the block. The caller closes and unlinks it when the pool is done.
+def share_distance_matrix(distances):
+    matrix = distances.matrix
+    memory = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+    shared = np.ndarray(matrix.shape, dtype=np.float64, buffer=memory.buf)
+    shared[:] = matrix
+    return memory
+
+# This function runs once in every worker process. It attaches to the shared memory block that holds the
+# distance matrix, so the matrix is never pickled and every worker reads the same copy.
+def _attach_shared_distances(memory_name, shape, addresses):
+    global _worker_memory, _worker_distances
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    matrix = np.ndarray(shape, dtype=np.float64, buffer=_worker_memory.buf)
+    _worker_distances = DistanceMatrix(addresses, matrix)
+
+# This function is the task each worker runs: the multi-start 2-opt for one truck's route of location ids,
+# or the anytime optimizer if a time budget is given.
+def _optimize_route_task(route, starts, seed, budget=None, perturb=False):
+    if budget is not None:
+        return anytime_optimize_indices(route, _worker_distances, budget, perturb, seed)
+    return multi_start_two_opt_indices(route, _worker_distances, starts, seed)
+
+# Define a class that optimizes several truck routes at the same time with a pool of worker processes.
+# Routes are passed as lists of location ids, which are much cheaper to send to a worker than addresses.
+# The distance matrix is copied once into shared memory when the pool starts. Each route gets its own seed
+# (seed plus its position in the batch) so results do not depend on which worker runs it.
+# With a budget (seconds per route) the workers run the anytime optimizer instead of multi-start 2-opt.
+class ParallelRouteOptimizer:
+    def __init__(self, distances, workers=None, starts=1, seed=0, budget=None, perturb=False):
+        self.starts = max(1, starts)
+        self.seed = seed
+        self.budget = budget
+        self.perturb = perturb
+        self.memory = share_distance_matrix(distances)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_attach_shared_distances,
+            initargs=(self.memory.name, distances.matrix.shape, distances.addresses)
+        )
+
+    def optimize(self, routes):
+        futures = [
+            self.executor.submit(_optimize_route_task, route, self.starts, self.seed + i, self.budget, self.perturb)
+            for i, route in enumerate(routes)
+        ]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown()
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Functions for partitioning a cycle's packages between the trucks by location below.
+
+# This function splits the packages in truck.packages into the units that can be moved to another truck,
+# each a list of packages that have to stay together (a group, or a single package), and the packages
+# that have to stay on their truck because they or their group are forced onto it.
+def movable_units(truck):
+    groups = {}
+    units = []
+    fixed = []
+    for pkg in truck.packages:
+        if pkg.group_id is not None:
+            groups.setdefault(pkg.group_id, []).append(pkg)
+        elif pkg.forced_truck is None:
+            units.append([pkg])
+        else:
+            fixed.append(pkg)
+    for members in groups.values():
+        if any(pkg.forced_truck is not None for pkg in members):
+            fixed.extend(members)
+        else:
+            units.append(members)
+    return units, fixed
+
+# This function picks the medoid of a set of locations: the one with the smallest total distance to the
+# others, counting a location once for every package delivered there.
+def medoid_of(locations, distances):
+    candidates, counts = np.unique(np.asarray(locations, dtype=np.intp), return_counts=True)
+    totals = distances.matrix[np.ix_(candidates, candidates)] @ counts
+    return int(candidates[np.argmin(totals)])
+
+# This function repartitions the packages the assignment queue loaded for this cycle so each truck gets
+# stops that are close together, with capacity-constrained k-medoids on the distance matrix.
+# The cycle's packages, their order of priority and the packages forced onto a truck stay the same; only the
+# movable units (see movable_units) change trucks. Each round gives every unit to the truck with the closest
+# medoid that still has room, taking groups first and then the units that would lose the most by not getting
+# their closest truck, and then moves every truck's medoid to the middle of its packages. A truck's forced packages count
+# toward its medoid. If a unit cannot be placed (large groups can make this happen), the queue's loads are kept.
+# Clustering trades deadlines for miles, so every truck's new load is routed the way it will be driven (with
+# optimize, by default two_opt_neighbor_indices) and the queue's loads are kept if the new loads reach more
+# stops after their deadline than the queue's loads do, or if they are not actually shorter to drive.
+# Returns True if the loads were repartitioned.
+def cluster_loads(trucks, distances, rounds=10, optimize=None):
+    units, fixed, room = [], [], []
+    for truck in trucks:
+        truck_units, truck_fixed = movable_units(truck)
+        units.extend(truck_units)
+        fixed.append(truck_fixed)
+        room.append(truck.capacity - len(truck_fixed))
+    if not units or sum(1 for r in room if r > 0) < 2:
+        return False
+    # Every package of a unit gets a row, and a unit's distance to a medoid is the sum over its rows.
+    # A unit's rows are next to each other, starting at starts[u].
+    sizes = np.array([len(unit) for unit in units])
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    unit_of = np.repeat(np.arange(len(units)), sizes)
+    locations = np.array([location_of(pkg, distances) for unit in units for pkg in unit], dtype=np.intp)
+    open_trucks = [t for t, r in enumerate(room) if r > 0]
+    # A truck that cannot reach a package before its deadline even by driving straight there from the hub
+    # is only used for that package's unit if no truck can.
+    hub = distances.index_of("4001 S 700 E")
+    deadlines = np.array([pkg.deadline_minutes for unit in units for pkg in unit])
+    leave = np.array([(trucks[t].current_time - DAY_START).total_seconds() / 60 for t in open_trucks])
+    speed = np.array([trucks[t].speed for t in open_trucks], dtype=np.float64)
+    arrive = leave + distances.matrix[hub, locations][:, None] / speed * 60
+    too_late = np.add.reduceat((arrive > deadlines[:, None]).astype(np.float64), starts, axis=0)
+    penalty = too_late * (distances.matrix.max() * len(locations) + 1)
+    # Trucks with forced packages start at their medoid. The others start at the unit location farthest from
+    # the medoids picked so far, starting from the hub, so the starting medoids are spread out.
+    medoids = {t: medoid_of([location_of(pkg, distances) for pkg in fixed[t]], distances)
+               for t in open_trucks if fixed[t]}
+    for t in open_trucks:
+        if t not in medoids:
+            anchors = list(medoids.values()) or [hub]
+            medoids[t] = int(locations[np.argmax(distances.matrix[np.ix_(locations, anchors)].min(axis=1))])
+    owner = None
+    for _ in range(rounds):
+        centers = np.array([medoids[t] for t in open_trucks], dtype=np.intp)
+        cost = penalty + np.add.reduceat(distances.matrix[np.ix_(locations, centers)], starts, axis=0)
+        preference = np.argsort(cost, axis=1, kind="stable")
+        ranked = np.take_along_axis(cost, preference, axis=1)
+        regret = ranked[:, 1] - ranked[:, 0]
+        left = [room[t] for t in open_trucks]
+        choices = preference.tolist()
+        unit_sizes = sizes.tolist()
+        new_owner = [-1] * len(units)
+        for u in np.lexsort((-regret, -sizes)).tolist():
+            for k in choices[u]:
+                if unit_sizes[u] <= left[k]:
+                    left[k] -= unit_sizes[u]
+                    new_owner[u] = k
+                    break
+            else:
+                return False
+        new_owner = np.array(new_owner)
+        if owner is not None and np.array_equal(owner, new_owner):
+            break
+        owner = new_owner
+        row_owner = owner[unit_of]
+        order = np.argsort(row_owner, kind="stable")
+        bounds = np.searchsorted(row_owner[order], np.arange(len(open_trucks) + 1))
+        for k, t in enumerate(open_trucks):
+            members = locations[order[bounds[k]:bounds[k+1]]].tolist()
+            members += [location_of(pkg, distances) for pkg in fixed[t]]
+            if members:
+                medoids[t] = medoid_of(members, distances)
+    truck_of = {pkg.package_id: open_trucks[k] for unit, k in zip(units, owner.tolist()) for pkg in unit}
+    for t, truck_fixed in enumerate(fixed):
+        for pkg in truck_fixed:
+            truck_of[pkg.package_id] = t
+    # I keep the queue's priority order within each truck's new load.
+    queue_loads = [truck.packages for truck in trucks]
+    late_before, miles_before = np.sum([routed_load(truck, distances, optimize) for truck in trucks], axis=0)
+    for truck in trucks:
+        truck.packages = []
+    for pkg in (pkg for load in queue_loads for pkg in load):
+        trucks[truck_of[pkg.package_id]].packages.append(pkg)
+    late_after, miles_after = np.sum([routed_load(truck, distances, optimize) for truck in trucks], axis=0)
+    if late_after > late_before or miles_after >= miles_before - 1e-9:
+        for truck, load in zip(trucks, queue_loads):
+            truck.packages = load
+        return False
+    for t, truck in enumerate(trucks):
+        for pkg in truck.packages:
+            pkg.truck_assigned = t + 1
+    return True
+
+# This function routes a truck's load the way it will be driven and returns how many stops are reached after
+# their deadline and the route's miles. optimize(route, truck) improves the nearest neighbor route; by default
+# it is two_opt_neighbor_indices.
+def routed_load(truck, distances, optimize=None):
+    if not truck.packages:
+        return 0, 0.0
+    route = plan_route_indices(truck, distances)
+    route = optimize(route, truck) if optimize is not None else two_opt_neighbor_indices(route, distances)
+    latest = route_latest_miles(truck.packages, truck.current_time, truck.speed, distances)
+    return len(late_stops(route, latest, distances)), route_index_distance(route, distances)
+
 # Functions for planning and delivering a single trip for a truck below.
 
 # This function plans an initial route for a truck using a greedy nearest neighbor approach.
-def plan_truck_route(truck, addresses, distances):
+# With vectorized=True the next stop is picked with NumPy instead of the min_distance_from loop.
+# Both modes break ties by distance table order, so they always build the same route.
+def plan_truck_route(truck, addresses, distances, vectorized=True):
     hub = "4001 S 700 E"
+    if vectorized:
+        return [distances.addresses[i] for i in plan_route_indices(truck, distances)]
+    # I use the set of unique location ids from the truck's packages, sorted in distance table order.
+    stops = [distances.addresses[i] for i in sorted({location_of(pkg, distances) for pkg in truck.packages})]
     current_address = hub
-    # I use a set (converted to list) of unique cleaned addresses from the truck's packages.
-    unvisited = list({clean_address(pkg.address) for pkg in truck.packages})
+    unvisited = stops
     route = [hub]
     # I keep adding the nearest unvisited address until all have been visited.
     while unvisited:
@@ -351,142 +2172,749 @@ def plan_truck_route(truck, addresses, distances):
     route.append(hub)  # End the route at the hub.
     return route
 
+# plan_truck_route for the simulation: the route is built and returned as location ids.
+def plan_route_indices(truck, distances):
+    stops = [location_of(pkg, distances) for pkg in truck.packages]
+    return nearest_neighbor_indices(distances.index_of("4001 S 700 E"), stops, distances)
+
+# This function builds a nearest neighbor route over matrix indices, starting and ending at start.
+# Each step takes the current stop's row of the matrix, masks the stops already visited and uses argmin.
+def nearest_neighbor_indices(start, stops, distances):
+    stops = np.unique(np.asarray(stops, dtype=np.intp))  # np.unique also sorts, so argmin ties go to the lowest index.
+    sub_matrix = distances.matrix[np.ix_(stops, stops)]
+    row = distances.matrix[start, stops]
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", sub_matrix.size + row.size)
+    visited = np.zeros(len(stops), dtype=bool)
+    order = []
+    for _ in range(len(stops)):
+        nearest = int(np.argmin(np.where(visited, np.inf, row)))
+        visited[nearest] = True
+        order.append(nearest)
+        row = sub_matrix[nearest]
+    return [start] + stops[order].tolist() + [start]
+
+# This function plans the initial routes for every truck in one call.
+# All trucks take a step together: their current rows are stacked and argmin picks every truck's next stop at once.
+def plan_truck_routes(trucks, addresses, distances):
+    return [[distances.addresses[i] for i in route] for route in plan_routes_indices(trucks, distances)]
+
+# plan_truck_routes on location ids.
+def plan_routes_indices(trucks, distances):
+    hub = distances.index_of("4001 S 700 E")
+    matrix = distances.matrix
+    unvisited = np.zeros((len(trucks), len(distances)), dtype=bool)
+    for t, truck in enumerate(trucks):
+        unvisited[t, [location_of(pkg, distances) for pkg in truck.packages]] = True
+    current = np.full(len(trucks), hub, dtype=np.intp)
+    routes = [[hub] for _ in trucks]
+    active = np.flatnonzero(unvisited.any(axis=1))
+    lookups = 0
+    while len(active):
+        rows = np.where(unvisited[active], matrix[current[active]], np.inf)
+        lookups += rows.size
+        nearest = np.argmin(rows, axis=1)
+        unvisited[active, nearest] = False
+        current[active] = nearest
+        for t, stop in zip(active.tolist(), nearest.tolist()):
+            routes[t].append(stop)
+        active = active[unvisited[active].any(axis=1)]
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", lookups)
+    return [route + [hub] for route in routes]
+
+# This function groups a truck's packages by the location id they are delivered to.
+# It is built once per trip so each stop only touches the packages delivered there.
+def build_stop_index(packages, distances):
+    stop_packages = {}
+    for pkg in packages:
+        stop_packages.setdefault(location_of(pkg, distances), []).append(pkg)
+    return stop_packages
+
 # This function simulates the delivery for a truck on one trip along a planned route.
+# The leg distances are read from the matrix in one step and turned into running totals, so each
+# delivery time comes straight from the cumulative travel time at its stop.
 def deliver_truck_route(truck, route, addresses, distances):
-    hub = "4001 S 700 E"
-    # I do not reset truck.current_time because I want time to accumulate over trips.
-    for i in range(len(route) - 1):
-        leg_distance = distance_between(route[i], route[i+1], addresses, distances)
-        truck.total_distance += leg_distance  # I add the distance of each leg to the truck's total.
-        travel_time = leg_distance / 18  # I calculate travel time assuming a speed of 18 mph.
-        truck.current_time += timedelta(hours=travel_time)
-        if route[i+1] != hub:
-            # For each package with a matching address, I mark it as delivered.
-            for pkg in truck.packages[:]:
-                if clean_address(pkg.address) == route[i+1]:
-                    pkg.delivery_time = truck.current_time
-                    pkg.status = f"Delivered at {pkg.delivery_time.strftime('%I:%M %p')} (Truck {pkg.truck_assigned})"
-                    truck.packages.remove(pkg)
+    deliver_route_indices(truck, distances.indices_of(route), distances)
+
+# deliver_truck_route on a route of location ids.
+def deliver_route_indices(truck, route, distances):
+    hub = distances.index_of("4001 S 700 E")
+    if len(route) < 2:
+        truck.at_hub = True
+        return
+    stops = np.asarray(route, dtype=np.intp)
+    legs = distances.matrix[stops[:-1], stops[1:]]
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", legs.size)
+    # I do not reset truck.current_time or total_distance because I want them to accumulate over trips.
+    odometer = np.cumsum(np.concatenate(([truck.total_distance], legs)))
+    # I calculate travel time from the truck's speed (18 mph by default).
+    elapsed_hours = np.cumsum(legs) / truck.speed
+    start_time = truck.current_time
+    stop_packages = build_stop_index(truck.packages, distances)
+    for i in range(1, len(route)):
+        if route[i] != hub:
+            # I mark every package for this stop as delivered.
+            packages = stop_packages.pop(route[i], None)
+            if packages:
+                delivery_time = start_time + timedelta(hours=float(elapsed_hours[i-1]))
+                for pkg in packages:
+                    pkg.mark_delivered(delivery_time)
+    truck.total_distance = odometer[-1]
+    truck.current_time = start_time + timedelta(hours=float(elapsed_hours[-1]))
+    # Any package whose address was not on the route stays on the truck.
+    truck.packages = [pkg for packages in stop_packages.values() for pkg in packages]
     truck.at_hub = True
 
+# This function applies the scheduled events that have happened by the time a truck is back at the hub,
+# for the lockstep loop in simulate_deliveries, which has no clock of its own. The package is forced onto a
+# truck whose own clock has reached the event, so it never leaves before it arrives or is corrected: a
+# delayed package goes on truck 2, which waits for the flight, if truck 2 is back by then and otherwise on
+# the first truck that is, and a corrected package goes on the last such truck. It returns the events that
+# are still to come.
+def release_scheduled_events(events, trucks, package_hash, queue):
+    pending = []
+    for event in events:
+        ready = [number for number, truck in enumerate(trucks, 1) if truck.current_time >= event.time]
+        if not ready:
+            pending.append(event)
+            continue
+        pkg = package_hash.search(event.package_id)
+        if pkg is not None:
+            if event.kind == ScheduledEvent.AVAILABLE:
+                pkg.forced_truck = 2 if 2 in ready else ready[0]
+            else:
+                pkg.forced_truck = ready[-1]
+        apply_event(event, package_hash, queue)
+    return pending
+
 # Multi-trip simulation function to deliver all packages while respecting truck capacity.
-def simulate_deliveries(trucks, addresses, distances, package_hash):
-    # I gather all packages (IDs 1 to 40) into a list.
-    all_packages = [package_hash.search(i) for i in range(1, 41)]
-    # I define undelivered packages as those that have no delivery_time set.
-    undelivered = [pkg for pkg in all_packages if pkg.delivery_time is None]
+# If an optimizer (a ParallelRouteOptimizer) is given, each cycle's routes are improved in parallel.
+# Otherwise the routes are improved with on_time_route_indices, which never makes an on-time stop late, or
+# with on_time=False with two_opt_neighbor_indices, which gives the shortest routes even if a package is late.
+# With partition="clusters" each cycle's loads are regrouped by location with cluster_loads before routing.
+# arrivals can move the delayed packages' arrival times (see default_events).
+def simulate_deliveries(trucks, addresses, distances, package_hash, optimizer=None, on_time=True,
+                        partition="priority", arrivals=None):
+    attach_event_log(trucks, distances)
+    # I put every undelivered package in the assignment queue.
+    events = default_events(package_hash, arrivals)
+    queue = AssignmentQueue(package_hash.values(), held_ids={event.package_id for event in events})
     # I continue simulation until every package has been delivered.
-    while undelivered:
-        sorted_packages = sorted(undelivered, key=priority_score)
-        # Record the current trip for each truck.
-        for truck in trucks:
+    while queue:
+        with profile_phase("assign"):
+            # Record the current trip for each truck.
+            for truck in trucks:
+                truck.packages = []
+            events = release_scheduled_events(events, trucks, package_hash, queue)
+            queue.assign(trucks)
+            if partition == "clusters":
+                on_time_routes = on_time and optimizer is None
+                cluster_loads(trucks, distances,
+                              optimize=partial(on_time_route_indices, distances=distances) if on_time_routes else None)
+        with profile_phase("construct"):
+            # Build the initial route for every loaded truck at once.
+            loaded_trucks = [truck for truck in trucks if truck.packages]
+            # If nothing could be loaded, no truck's clock moves and the next cycle would be the same.
+            if not loaded_trucks:
+                raise RuntimeError(f"{len(queue)} package(s) could not be assigned to any truck")
+            initial_routes = plan_routes_indices(loaded_trucks, distances)
+        with profile_phase("2-opt"):
+            # The trucks' routes don't depend on each other, so they can all be optimized at the same time.
+            if optimizer is not None:
+                optimized_routes = optimizer.optimize(initial_routes)
+            elif on_time:
+                optimized_routes = [on_time_route_indices(route, truck, distances)
+                                    for truck, route in zip(loaded_trucks, initial_routes)]
+            else:
+                optimized_routes = [two_opt_neighbor_indices(route, distances) for route in initial_routes]
+        with profile_phase("deliver"):
+            for truck, initial_route, optimized_route in zip(loaded_trucks, initial_routes, optimized_routes):
+                run_truck_trip(truck, initial_route, optimized_route, addresses, distances)
+
+# This function drives one loaded truck along its optimized route and records the trip in the truck's event log.
+# Both routes are lists of location ids.
+def run_truck_trip(truck, initial_route, optimized_route, addresses, distances):
+    # Save the load and start time.
+    trip_start_load = truck.packages.copy()
+    trip_start_time = truck.current_time
+    #accumulate baseline distance (distance before 2-opt)
+    baseline_miles = route_index_distance(initial_route, distances)
+    truck.baseline_distance += baseline_miles
+    deliver_route_indices(truck, optimized_route, distances)
+    # The packages still on the truck were not delivered on this trip.
+    remaining = {pkg.package_id for pkg in truck.packages}
+    delivered = [pkg for pkg in trip_start_load if pkg.package_id not in remaining]
+    arrivals = route_arrival_times(optimized_route, trip_start_time, truck.speed, distances)
+    truck.log.append_trip(truck.number, trip_start_load, initial_route, optimized_route, arrivals, delivered, distances)
+
+# This function builds the scheduled events implied by the manifest's notes: delayed packages become
+# available when their flight lands, and a wrong address is corrected as listed in ADDRESS_CORRECTIONS.
+# arrivals can give a delayed package's arrival time instead of its note, as {package id: time}.
+def default_events(package_hash, arrivals=None):
+    arrivals = arrivals or {}
+    events = []
+    for pkg in package_hash.values():
+        if pkg.delivery_time is not None:
+            continue
+        if pkg.delayed_delivery:
+            # I read the arrival time from the note ("... until 9:05 am") and fall back to 9:05 AM.
+            match = re.search(r"(\d{1,2}:\d{2}\s*[AaPp][Mm])", pkg.notes)
+            arrival = DELAYED_ARRIVAL
+            if pkg.package_id in arrivals:
+                arrival = arrivals[pkg.package_id]
+            elif match:
+                arrival = datetime.strptime(match.group(1).upper().replace(" ", ""), "%I:%M%p")
+            events.append(ScheduledEvent(arrival, ScheduledEvent.AVAILABLE, pkg.package_id))
+        if pkg.hold and pkg.package_id in ADDRESS_CORRECTIONS:
+            corrected_at, address = ADDRESS_CORRECTIONS[pkg.package_id]
+            events.append(ScheduledEvent(corrected_at, ScheduledEvent.ADDRESS_CHANGE, pkg.package_id, address))
+    return events
+
+# This function applies a scheduled event to its package and releases the package to the assignment queue.
+def apply_event(event, package_hash, queue):
+    pkg = package_hash.search(event.package_id)
+    if pkg is None:
+        print(f"Warning: event for unknown package {event.package_id} ignored", file=sys.stderr)
+        return
+    if event.kind == ScheduledEvent.AVAILABLE:
+        pkg.delayed_delivery = False
+    elif event.kind == ScheduledEvent.ADDRESS_CHANGE:
+        if pkg.original_address is None:
+            pkg.original_address = pkg.address
+        pkg.address = event.address
+        pkg.address_update_time = event.time
+        pkg.hold = False
+    queue.release_package(event.package_id)
+
+# Discrete-event dispatcher for any number of trucks.
+# Trucks sit in a heap keyed by the time they are next free at the hub, and whichever truck is free first
+# gets the next load. Scheduled events (see default_events) are applied once the clock reaches them, so
+# delayed packages and address corrections need no special cases. Each truck uses its own capacity and speed.
+# arrivals is passed on to default_events when events is not given. optimizer and on_time work as in
+# simulate_deliveries.
+def dispatch_deliveries(trucks, addresses, distances, package_hash, events=None, optimizer=None, on_time=True,
+                        arrivals=None):
+    attach_event_log(trucks, distances)
+    if events is None:
+        events = default_events(package_hash, arrivals)
+    pending = [(event.time, seq, event) for seq, event in enumerate(events)]
+    heapify(pending)
+    queue = AssignmentQueue(package_hash.values(), held_ids={event.package_id for event in events})
+    available = [(truck.current_time, t) for t, truck in enumerate(trucks)]
+    heapify(available)
+    while queue and available:
+        now, t = heappop(available)
+        truck = trucks[t]
+        with profile_phase("assign"):
+            while pending and pending[0][0] <= now:
+                apply_event(heappop(pending)[2], package_hash, queue)
             truck.packages = []
-        # Separate grouped and individual packages.
-        group_dict = {}
-        individuals = []
-        for pkg in sorted_packages:
-            if pkg.group_id is not None:
-                group_dict.setdefault(pkg.group_id, []).append(pkg)
+            queue.assign(trucks, only=t)
+        if not truck.packages:
+            # Nothing here fits this truck. It waits at the hub for the next event, or it is done for the day.
+            if pending:
+                truck.current_time = max(truck.current_time, pending[0][0])
+                heappush(available, (truck.current_time, t))
+            continue
+        with profile_phase("construct"):
+            initial_route = plan_route_indices(truck, distances)
+        with profile_phase("2-opt"):
+            if optimizer is not None:
+                optimized_route = optimizer.optimize([initial_route])[0]
+            elif on_time:
+                optimized_route = on_time_route_indices(initial_route, truck, distances)
             else:
-                individuals.append(pkg)
-        # Assign grouped packages first.
-        for group in group_dict.values():
-            # Try to assign the entire group to a truck.
-            forced_truck_for_group = None
-            for p in group:
-                if p.forced_truck is not None:
-                    forced_truck_for_group = p.forced_truck
+                optimized_route = two_opt_neighbor_indices(initial_route, distances)
+        with profile_phase("deliver"):
+            run_truck_trip(truck, initial_route, optimized_route, addresses, distances)
+        heappush(available, (truck.current_time, t))
+    if queue:
+        raise RuntimeError(f"{len(queue)} package(s) could not be assigned to any truck")
+
+# Functions and a class for re-planning a finished day when something changes, below.
+
+# This function returns the time a truck reaches each stop of a route of location ids, leaving at start_time.
+def route_arrival_times(route, start_time, speed, distances):
+    stops = np.asarray(route, dtype=np.intp)
+    elapsed_hours = np.cumsum(distances.matrix[stops[:-1], stops[1:]]) / speed
+    if PROFILER is not None:
+        PROFILER.count("distance_lookups", len(elapsed_hours))
+    return [start_time] + [start_time + timedelta(hours=hours) for hours in elapsed_hours.tolist()]
+
+# This function inserts a stop into a route of location ids where it adds the fewest miles.
+# The first and last stops of the route stay where they are.
+def cheapest_insertion(route, stop, distances):
+    matrix = distances.matrix
+    before = np.asarray(route[:-1], dtype=np.intp)
+    after = np.asarray(route[1:], dtype=np.intp)
+    added = matrix[before, stop] + matrix[stop, after] - matrix[before, after]
+    position = int(np.argmin(added)) + 1
+    return route[:position] + [stop] + route[position:]
+
+# A 2-opt for a route whose first and last stops are fixed but need not be the same, such as the rest of a
+# trip from wherever the truck is now back to the hub. Each move is scored by the two edges it changes.
+def two_opt_path_indices(route, distances):
+    n = len(route)
+    if n < 4:
+        return list(route)
+    dist = distances.matrix[np.ix_(route, route)].tolist()
+    tour = list(range(n))
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 2):
+            for j in range(i + 1, n - 1):
+                a, b, c, d = tour[i-1], tour[i], tour[j], tour[j+1]
+                if dist[a][c] + dist[b][d] - dist[a][b] - dist[c][d] < -1e-9:
+                    tour[i:j+1] = tour[i:j+1][::-1]
+                    improved = True
+    return [route[k] for k in tour]
+
+# Define a live plan: an API for changing a day that has already been simulated, without simulating it again.
+# Each change happens at a time "now". Only the trucks it touches are re-planned, and a truck that is out on a
+# trip keeps the stops it has already made and the stop it is driving to. The rest of that trip starts from
+# the order in truck.routes, new stops are put in where they add the fewest miles, and 2-opt is run on what is
+# left. The truck's later trips keep their loads and routes and are only moved later if the trip runs long.
+# Packages that need a new truck go on the trip that leaves first after now and still has room, or on a new
+# trip for the truck that is back at the hub first. Every method returns the truck numbers it re-planned.
+# An EventTimeline built before a change is out of date afterwards and should be built again.
+class LivePlan:
+    HUB = "4001 S 700 E"
+
+    def __init__(self, trucks, package_hash, distances):
+        self.trucks = trucks
+        self.package_hash = package_hash
+        self.distances = distances
+        self.hub = distances.index_of(LivePlan.HUB)
+        # trip_of maps a package id to (truck index, trip index) for the trip that delivers it.
+        self.trip_of = {}
+        for t, truck in enumerate(trucks):
+            # Re-planning edits the trips in place, so they are rebuilt from the event log into lists once here.
+            truck.keep_history()
+            for k, trip in enumerate(truck.trip_history):
+                for pkg in trip["packages"]:
+                    self.trip_of[pkg.package_id] = (t, k)
+
+    def _package(self, package_id):
+        pkg = self.package_hash.search(package_id)
+        if pkg is None:
+            raise ValueError(f"Package {package_id} is not in the manifest")
+        return pkg
+
+    # Corrects a package's address. The truck carrying it re-plans the rest of that trip.
+    def correct_address(self, package_id, address, now):
+        pkg = self._package(package_id)
+        if pkg.delivery_time is not None and pkg.delivery_time <= now:
+            raise ValueError(f"Package {package_id} was already delivered at {pkg.delivery_time.strftime('%I:%M %p')}")
+        address = clean_address(address)
+        self.distances.index_of(address)  # Raises ValueError for an address that is not in the distance table.
+        if pkg.original_address is None:
+            pkg.original_address = pkg.address
+        pkg.address = address
+        pkg.address_update_time = now
+        if pkg.package_id not in self.trip_of:
+            return []
+        t, k = self.trip_of[pkg.package_id]
+        self._replan_trip(t, k, now)
+        return [t + 1]
+
+    # Adds a package that arrives at the hub at now.
+    def add_package(self, pkg, now):
+        if pkg.package_id in self.package_hash:
+            raise ValueError(f"Package {pkg.package_id} is already in the manifest")
+        location_of(pkg, self.distances)  # Raises ValueError for an address that is not in the distance table.
+        self.package_hash.insert(pkg.package_id, pkg)
+        return self._assign([self.package_hash.search(pkg.package_id)], now)
+
+    # Records that a delayed package only reaches the hub at now. If it was planned on a trip that left
+    # before then, it comes off that trip, along with the undelivered packages of its group, and is reloaded.
+    def package_available(self, package_id, now):
+        pkg = self._package(package_id)
+        if pkg.package_id not in self.trip_of:
+            return self._assign([pkg], now)
+        t, k = self.trip_of[pkg.package_id]
+        trip = self.trucks[t].trip_history[k]
+        if trip["start_time"] >= now:
+            return []
+        moved = [pkg]
+        if pkg.group_id is not None:
+            moved += [other for other in trip["packages"] if other.group_id == pkg.group_id and other is not pkg
+                      and (other.delivery_time is None or other.delivery_time > now)]
+        for other in moved:
+            trip["packages"].remove(other)
+            del self.trip_of[other.package_id]
+            other.delivery_time = None
+            other.status = "At the hub"
+            other.truck_assigned = None
+        self._replan_trip(t, k, now)
+        return sorted({t + 1} | set(self._assign(moved, now)))
+
+    # Takes a truck out of service at now. It stops at the last stop it reached, its later trips are
+    # cancelled, and every package it has not delivered goes to the other trucks. The truck's position is not
+    # modeled after that: the packages still on it are treated as back at the hub at now, as if they were
+    # brought back right away, so the trip to fetch them is not counted in anyone's miles or times.
+    def break_down(self, truck_number, now):
+        if not 1 <= truck_number <= len(self.trucks):
+            raise ValueError(f"Truck {truck_number} does not exist, there are {len(self.trucks)} trucks")
+        t = truck_number - 1
+        truck = self.trucks[t]
+        truck.out_of_service = now
+        orphans = []
+        kept = [k for k, trip in enumerate(truck.trip_history) if trip["start_time"] < now]
+        if kept and truck.trip_history[kept[-1]]["end_time"] > now:
+            k = kept[-1]
+            trip = truck.trip_history[k]
+            route = self.distances.indices_of(truck.routes[k]["optimized_route"])
+            arrivals = route_arrival_times(route, trip["start_time"], truck.speed, self.distances)
+            reached = bisect_right(arrivals, now)
+            truck.routes[k]["optimized_route"] = [self.distances.addresses[i] for i in route[:reached]]
+            trip["end_time"] = now
+            # The undelivered packages stay in this trip's record, since they were on the truck until now.
+            orphans += [pkg for pkg in trip["packages"] if pkg.delivery_time is None or pkg.delivery_time > now]
+        for k in range(len(kept), len(truck.trip_history)):
+            orphans += truck.trip_history[k]["packages"]
+            initial_route = self.distances.indices_of(truck.routes[k]["initial_route"])
+            truck.baseline_distance -= route_index_distance(initial_route, self.distances)
+        del truck.trip_history[len(kept):]
+        del truck.routes[len(kept):]
+        for pkg in orphans:
+            del self.trip_of[pkg.package_id]
+            pkg.delivery_time = None
+            pkg.status = "At the hub"
+            pkg.truck_assigned = None
+        self._update_totals(truck)
+        # Groups are moved together so they still end up on one trip.
+        units = {}
+        for pkg in orphans:
+            units.setdefault(pkg.group_id if pkg.group_id is not None else ("package", pkg.package_id), []).append(pkg)
+        # Every unit is placed first and each trip that got packages is re-planned once afterwards.
+        trips = {self._place(unit, now) for unit in sorted(units.values(), key=lambda unit: min(map(priority_score, unit)))}
+        for t, k in sorted(trips):
+            self._replan_trip(t, k, now)
+        return sorted({truck_number} | {t + 1 for t, _ in trips})
+
+    # Puts packages that are at the hub at now on one trip, re-plans it and returns the truck number.
+    def _assign(self, packages, now):
+        t, k = self._place(packages, now)
+        self._replan_trip(t, k, now)
+        return [t + 1]
+
+    # Chooses the trip for packages that are at the hub at now and adds them to it. Returns (truck index, trip index).
+    # The trip that leaves first wins: a planned trip that has not left and has room, or a new trip on a truck
+    # that is (or will be) back at the hub. On a tie a planned trip is chosen, since it makes no extra trip.
+    def _place(self, packages, now):
+        # Only a note's truck is honored. forced_truck may instead be a truck the first plan picked for a
+        # delayed package, which is no reason to keep it there now.
+        forced = {required_truck(pkg.notes) for pkg in packages} - {None}
+        candidates = [
+            t for t, truck in enumerate(self.trucks)
+            if truck.out_of_service is None and len(packages) <= truck.capacity
+            and (not forced or forced == {t + 1})
+        ]
+        # A forced truck that is out of service or missing cannot be honored, so any working truck will do.
+        if not candidates:
+            candidates = [t for t, truck in enumerate(self.trucks)
+                          if truck.out_of_service is None and len(packages) <= truck.capacity]
+        if not candidates:
+            raise RuntimeError(f"No working truck can take package(s) {[pkg.package_id for pkg in packages]}")
+        best = None
+        for t in candidates:
+            truck = self.trucks[t]
+            options = [(max(truck.current_time, now), 1, t, None)]
+            for k, trip in enumerate(truck.trip_history):
+                if trip["start_time"] >= now and len(trip["packages"]) + len(packages) <= truck.capacity:
+                    options.append((trip["start_time"], 0, t, k))
                     break
-            if forced_truck_for_group is not None:
-                target_truck = trucks[forced_truck_for_group - 1]
-                if len(target_truck.packages) + len(group) <= target_truck.capacity:
-                    for p in group:
-                        target_truck.packages.append(p)
-                        p.truck_assigned = forced_truck_for_group
+            best = min([best] + options if best is not None else options)
+        _, _, t, k = best
+        if k is None:
+            # A new trip leaves when the truck is back at the hub after its last trip.
+            truck = self.trucks[t]
+            start = max(truck.current_time, now)
+            truck.trip_history.append({"start_time": start, "end_time": start, "packages": []})
+            truck.routes.append({"initial_route": [LivePlan.HUB, LivePlan.HUB],
+                                 "optimized_route": [LivePlan.HUB, LivePlan.HUB]})
+            k = len(truck.trip_history) - 1
+        trip = self.trucks[t].trip_history[k]
+        for pkg in packages:
+            pkg.truck_assigned = t + 1
+            trip["packages"].append(pkg)
+            self.trip_of[pkg.package_id] = (t, k)
+        return t, k
+
+    # Re-plans the part of trip k of truck t that is still ahead at now, then re-times the truck's later trips.
+    def _replan_trip(self, t, k, now):
+        truck = self.trucks[t]
+        trip = truck.trip_history[k]
+        entry = truck.routes[k]
+        route = self.distances.indices_of(entry["optimized_route"])
+        if trip["start_time"] >= now:
+            # The trip has not left yet, so all of it can change.
+            reached = 1
+        else:
+            arrivals = route_arrival_times(route, trip["start_time"], truck.speed, self.distances)
+            # The truck keeps the stops it has reached and the one it is driving to, unless that is the hub.
+            reached = min(bisect_right(arrivals, now) + 1, len(route) - 1)
+        current = route[reached - 1]
+        pending = [pkg for pkg in trip["packages"] if pkg.delivery_time is None or pkg.delivery_time > now]
+        needed = {location_of(pkg, self.distances) for pkg in pending} - {current}
+        # The rest of the trip starts in its old order, without stops that are no longer needed.
+        remaining = [current]
+        for stop in route[reached:-1]:
+            if stop in needed and stop not in remaining:
+                remaining.append(stop)
+        remaining.append(self.hub)
+        for stop in sorted(needed - set(remaining)):
+            remaining = cheapest_insertion(remaining, stop, self.distances)
+        new_trip = len(route) == 2 and route[0] == route[1] == self.hub
+        if new_trip:
+            # A new trip counts its route before 2-opt in the baseline, like the trips simulate_deliveries makes.
+            entry["initial_route"] = [self.distances.addresses[i] for i in remaining]
+            truck.baseline_distance += route_index_distance(remaining, self.distances)
+        remaining = two_opt_path_indices(remaining, self.distances)
+        if trip["start_time"] >= now:
+            # A trip that has not left may start with its earliest deadlines if the shorter route misses one
+            # (see on_time_route_indices).
+            latest = route_latest_miles(pending, trip["start_time"], truck.speed, self.distances)
+            late = late_stops(remaining, latest, self.distances)
+            if late:
+                fallback = deadline_first_indices(remaining, latest, self.distances)
+                if len(late_stops(fallback, latest, self.distances)) < len(late):
+                    remaining = fallback
+        new_route = route[:reached - 1] + remaining
+        entry["optimized_route"] = [self.distances.addresses[i] for i in new_route]
+        entry["replanned_at"] = now
+        self._deliver_trip(truck, trip, new_route, reached - 1, now)
+        # Later trips keep their routes. They leave when this one is back, but never earlier than planned.
+        previous_end = trip["end_time"]
+        for later, later_entry in zip(truck.trip_history[k + 1:], truck.routes[k + 1:]):
+            later["start_time"] = max(later["start_time"], previous_end)
+            self._deliver_trip(truck, later, self.distances.indices_of(later_entry["optimized_route"]), 0, now)
+            previous_end = later["end_time"]
+        self._update_totals(truck)
+
+    # Sets the delivery times of a trip's packages from its route. Packages delivered by now keep their time;
+    # the others are delivered at the first stop at or after position first_open that matches their address.
+    def _deliver_trip(self, truck, trip, route, first_open, now):
+        arrivals = route_arrival_times(route, trip["start_time"], truck.speed, self.distances)
+        first_visit = {}
+        for position in range(len(route) - 1, first_open - 1, -1):
+            first_visit[route[position]] = position
+        for pkg in trip["packages"]:
+            if pkg.delivery_time is not None and pkg.delivery_time <= now:
+                continue
+            position = first_visit.get(location_of(pkg, self.distances))
+            if position is None:
+                pkg.delivery_time = None
+                pkg.status = "At the hub"
             else:
-                for truck in trucks:
-                    if len(truck.packages) + len(group) <= truck.capacity:
-                        for p in group:
-                            truck.packages.append(p)
-                            p.truck_assigned = trucks.index(truck) + 1
-                        break
-            # If the entire group cannot be assigned in this cycle, do nothing.
-            # They will be reattempted in a later simulation cycle.
+                pkg.mark_delivered(arrivals[position])
+        trip["end_time"] = arrivals[-1]
 
-        # Assign individual packages.
-        for pkg in individuals:            
-            for truck in trucks:
-                # For package #9, only assign if the truck's current time is >= 10:20 AM.
-                if pkg.package_id == 9:
-                    if truck.current_time < datetime.strptime("10:20 AM", "%I:%M %p"):
-                        # Skip this truck for package #9; it remains unassigned this cycle.
-                        continue
-                    else:
-                        # Update package #9's address when eligible.
-                        pkg.address_update_time = truck.current_time
-                        pkg.address = "410 S STATE ST"
-                        pkg.hold = False
-                        pkg.forced_truck = trucks.index(truck) + 1
-                elif pkg.delayed_delivery:
-                    if truck.current_time < datetime.strptime("9:05 AM", "%I:%M %p"):
-                        # Skip this truck for the package; it remains unassigned this cycle.
-                        continue
-                    else:
-                        # Truck 2 is setup to wait for the delayed flight - make sure packages that are on the delayed flight are forced to this truck
-                        pkg.forced_truck = 2
-                        # Update the package to un-delay it
-                        pkg.delayed_delivery = False
+    def _update_totals(self, truck):
+        truck.total_distance = sum(
+            route_index_distance(self.distances.indices_of(entry["optimized_route"]), self.distances)
+            for entry in truck.routes
+        )
+        if truck.trip_history:
+            truck.current_time = truck.trip_history[-1]["end_time"]
 
+# This function reads a live event from the command line and applies it to a LivePlan.
+# The forms are "<time> address <package id> <new address>", "<time> available <package id>",
+# "<time> breakdown <truck number>" and "<time> package <package CSV row>".
+def apply_live_event(plan, text):
+    match = re.fullmatch(r"\s*(\d{1,2}:\d{2}\s*[AaPp][Mm])\s+(\w+)\s+(.+?)\s*", text)
+    if match is None:
+        raise ValueError(f"unrecognized event: {text}")
+    now = parse_query_time(match.group(1))
+    kind, rest = match.group(2).lower(), match.group(3)
+    if kind == "address":
+        package_id, _, address = rest.partition(" ")
+        return plan.correct_address(int(package_id), address, now)
+    if kind == "available":
+        return plan.package_available(int(rest), now)
+    if kind == "breakdown":
+        return plan.break_down(int(rest), now)
+    if kind == "package":
+        row = next(csv.reader([rest]))
+        row += [""] * (8 - len(row))  # The notes and other trailing columns may be left off.
+        return plan.add_package(package_from_row(row), now)
+    raise ValueError(f"unknown event type: {kind}")
 
-            # Check handling skipping package #9 if necessary, as well as the delayed packages
-            if pkg.hold or pkg.delayed_delivery:
-                continue
+# Functions for running the whole day many times with different inputs (what-if scenarios) below.
+
+# The inputs a scenario can change and their values when it doesn't. starts is a comma-separated list of
+# start times for the first trucks (the rest start at 8:00 AM); without it the trucks start the way main()
+# starts them. flight_arrival is when the delayed packages reach the hub, and arrivals can give single
+# delayed packages their own time, as {"package id": "time"}.
+SCENARIO_DEFAULTS = {
+    "trucks": 2, "capacity": 16, "speed": 18, "starts": None, "flight_arrival": "9:05 AM", "arrivals": {},
+    "dispatcher": "cycles", "partition": "priority", "on_time": True,
+}
+SCENARIO_COLUMNS = (["scenario"] + list(SCENARIO_DEFAULTS) +
+                    ["miles", "baseline_miles", "delivered", "late", "on_time_rate", "finish", "trips", "error"])
+
+# This function turns a scenario file's contents into a list of scenarios. The file holds a grid, or a list of
+# grids: every key whose value is a list is an axis, and each combination of the axes' values is one scenario.
+# For example {"trucks": [2, 3], "speed": [18, 25]} gives four scenarios.
+def expand_scenarios(spec):
+    scenarios = []
+    for grid in (spec if isinstance(spec, list) else [spec]):
+        unknown = sorted(set(grid) - set(SCENARIO_DEFAULTS))
+        if unknown:
+            raise ValueError(f"unknown scenario setting(s): {', '.join(unknown)}")
+        keys = list(grid)
+        axes = [grid[key] if isinstance(grid[key], list) else [grid[key]] for key in keys]
+        for values in itertools.product(*axes):
+            scenario = dict(SCENARIO_DEFAULTS)
+            scenario.update(zip(keys, values))
+            scenarios.append(scenario)
+    return scenarios
+
+# This function raises ValueError if a scenario's settings have the wrong type or an unknown value.
+# Scenario files are written by hand, so a bad value is reported for its own scenario instead of failing
+# somewhere inside the simulation.
+def check_scenario(scenario):
+    for key in ("trucks", "capacity"):
+        if type(scenario[key]) is not int or scenario[key] < 1:
+            raise ValueError(f"{key} must be a positive whole number, not {scenario[key]!r}")
+    if type(scenario["speed"]) not in (int, float) or scenario["speed"] <= 0:
+        raise ValueError(f"speed must be a positive number, not {scenario['speed']!r}")
+    for key in ("starts", "flight_arrival"):
+        if not isinstance(scenario[key], str) and not (key == "starts" and scenario[key] is None):
+            raise ValueError(f"{key} must be a string of times, not {scenario[key]!r}")
+    if not isinstance(scenario["arrivals"], dict):
+        raise ValueError(f"arrivals must map package ids to times, not {scenario['arrivals']!r}")
+    if scenario["dispatcher"] not in ("cycles", "events"):
+        raise ValueError(f"dispatcher must be cycles or events, not {scenario['dispatcher']!r}")
+    if scenario["partition"] not in ("priority", "clusters"):
+        raise ValueError(f"partition must be priority or clusters, not {scenario['partition']!r}")
+    if scenario["dispatcher"] == "events" and scenario["partition"] == "clusters":
+        raise ValueError("partition clusters needs the cycles dispatcher")
+    if not isinstance(scenario["on_time"], bool):
+        raise ValueError(f"on_time must be true or false, not {scenario['on_time']!r}")
+
+# This function runs the whole day once for a scenario, on a freshly loaded manifest, and returns its row of
+# the results table. A scenario with bad settings (see check_scenario) or one that cannot be delivered
+# (for example a group larger than the trucks, or a plan that sends a package out before it is ready)
+# gets its error in the row instead of stopping the run.
+def run_scenario(scenario, package_file, distances):
+    row = {key: scenario[key] for key in SCENARIO_DEFAULTS}
+    row["arrivals"] = json.dumps(scenario["arrivals"]) if scenario["arrivals"] else ""
+    try:
+        check_scenario(scenario)
+        package_hash = load_package_data(package_file)
+        assign_location_ids(package_hash.values(), distances)
+        flight = parse_query_time(scenario["flight_arrival"])
+        arrivals = {pkg.package_id: flight for pkg in package_hash.values() if pkg.delayed_delivery}
+        arrivals.update({int(package_id): parse_query_time(time) for package_id, time in scenario["arrivals"].items()})
+        ready_at = {}
+        for event in default_events(package_hash, arrivals):
+            ready_at[event.package_id] = max(event.time, ready_at.get(event.package_id, event.time))
+        trucks = [Truck(scenario["capacity"], scenario["speed"]) for _ in range(scenario["trucks"])]
+        if scenario["starts"]:
+            for truck, start in zip(trucks, scenario["starts"].split(",")):
+                truck.current_time = parse_query_time(start)
+        elif scenario["dispatcher"] == "cycles" and len(trucks) > 1:
+            # Like main(), truck 2 waits for the delayed flight.
+            trucks[1].current_time = flight
+        # The scenario's own output (warnings, the summary) is not part of the results table.
+        with redirect_stdout(None):
+            if scenario["dispatcher"] == "events":
+                dispatch_deliveries(trucks, distances.addresses, distances, package_hash,
+                                    on_time=scenario["on_time"], arrivals=arrivals)
             else:
-                # If this package is forced to a specific truck, assign it only to that truck.
-                if pkg.forced_truck is not None:
-                    target_truck = trucks[pkg.forced_truck - 1]
-                    if len(target_truck.packages) < target_truck.capacity:
-                        target_truck.packages.append(pkg)
-                        pkg.truck_assigned = pkg.forced_truck
-                        continue
-                    else:
-                        continue  # Leave unassigned if forced truck is full.
-                else:
-                    # Regular assignment to the first truck with available capacity.
-                    for truck in trucks:
-                        if len(truck.packages) < truck.capacity:
-                            truck.packages.append(pkg)
-                            pkg.truck_assigned = trucks.index(truck) + 1
-                            break
-        # Record trip history before delivering.
-        for truck in trucks:
-            if truck.packages:
-                # Save the load and start time.
-                trip_start_load = truck.packages.copy()
-                trip_start_time = truck.current_time
-                initial_route = plan_truck_route(truck, addresses, distances)
-                baseline_miles = route_distance(initial_route, addresses, distances)
-                truck.baseline_distance += baseline_miles
-                optimized_route = two_opt(initial_route, addresses, distances)
-                #record the initial and optimized routes
-                truck.routes.append({
-                    "initial_route": initial_route[:],
-                    "optimized_route": optimized_route[:]
-                })
-                #accumulate baseline distance (distance before 2-opt)
-                deliver_truck_route(truck, optimized_route, addresses, distances)
-                # Append a trip record to trip_history.
-                truck.trip_history.append({
-                    "start_time": trip_start_time,
-                    "end_time": truck.current_time,
-                    "packages": trip_start_load
-                })
-        undelivered = [pkg for pkg in all_packages if pkg.delivery_time is None]
+                simulate_deliveries(trucks, distances.addresses, distances, package_hash,
+                                    on_time=scenario["on_time"], partition=scenario["partition"], arrivals=arrivals)
+        # A plan that takes a package out before it is ready can't be driven, so it is not a valid result.
+        early = early_departures(trucks, ready_at)
+        if early:
+            raise RuntimeError(f"package(s) {', '.join(map(str, early))} left the hub before they were ready")
+    except (RuntimeError, ValueError) as e:
+        row["error"] = str(e)
+        return row
+    delivered = sum(1 for pkg in package_hash.values() if pkg.delivery_time is not None)
+    late = len(missed_deadlines(package_hash))
+    row.update({
+        "miles": round(float(sum(truck.total_distance for truck in trucks)), 1),
+        "baseline_miles": round(float(sum(truck.baseline_distance for truck in trucks)), 1),
+        "delivered": delivered,
+        "late": late,
+        "on_time_rate": round((delivered - late) / delivered, 4) if delivered else 0.0,
+        "finish": max(truck.current_time for truck in trucks).strftime("%I:%M %p"),
+        "trips": sum(truck.log.trip_count(truck.number) for truck in trucks),
+        "error": "",
+    })
+    return row
+
+# This function is the task each worker runs for run_scenarios.
+def _run_scenario_task(scenario, package_file):
+    return run_scenario(scenario, package_file, _worker_distances)
+
+# This function runs every scenario in a pool of worker processes that share one read-only copy of the
+# distance matrix (see share_distance_matrix) and yields their result rows in order, numbered from 1,
+# as soon as each one is ready. workers=None uses one process per CPU, and workers=0 runs them in this process
+# (like --workers 0 everywhere else).
+def run_scenarios(scenarios, package_file, distances, workers=None):
+    if workers == 0:
+        for number, scenario in enumerate(scenarios, 1):
+            yield {"scenario": number, **run_scenario(scenario, package_file, distances)}
+        return
+    memory = share_distance_matrix(distances)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_shared_distances,
+                                 initargs=(memory.name, distances.matrix.shape, distances.addresses)) as executor:
+            # Scenarios are sent to the workers in batches so thousands of small tasks don't each pay for a round trip.
+            chunk_size = max(1, len(scenarios) // ((workers or os.cpu_count() or 1) * 8))
+            rows = executor.map(_run_scenario_task, scenarios, [package_file] * len(scenarios), chunksize=chunk_size)
+            for number, row in enumerate(rows, 1):
+                yield {"scenario": number, **row}
+    finally:
+        memory.close()
+        memory.unlink()
+
+# This function writes the results table as CSV while the scenarios run, so a long run's finished rows are
+# kept even if it is stopped. Returns the rows.
+def write_scenario_results(rows, output):
+    writer = csv.DictWriter(output, fieldnames=SCENARIO_COLUMNS)
+    writer.writeheader()
+    results = []
+    for row in rows:
+        writer.writerow(row)
+        output.flush()
+        results.append(row)
+    return results
+
+# This function prints a short summary of a scenario run: how many ran and failed, and the scenario with
+# the fewest miles among those that delivered every package on time.
+def summarize_scenarios(results, elapsed):
+    failed = [row for row in results if row["error"]]
+    print(f"Ran {len(results)} scenario(s) in {elapsed:.1f} s, {len(failed)} failed")
+    on_time = [row for row in results if not row["error"] and row["late"] == 0]
+    if on_time:
+        best = min(on_time, key=lambda row: row["miles"])
+        print(f"Fewest miles with every package on time: scenario {best['scenario']}, {best['miles']} miles, "
+              f"done at {best['finish']}")
+    else:
+        print("No scenario delivered every package on time.")
 
 # Function to display truck loads (which packages are loaded on each truck) at a given query time.
-def display_truck_loads(trucks, query_time):
+# If a timeline is given, I look up each truck's trip with a binary search instead of scanning its history.
+def display_truck_loads(trucks, query_time, timeline=None):
     print(f"\nTruck Loads at {query_time.strftime('%I:%M %p')}:")
     for idx, truck in enumerate(trucks):
+        if timeline is not None:
+            trip = timeline.trip_at(idx, query_time)
+            if trip is not None:
+                print(f"Truck {idx+1}:")
+                for pkg in trip["packages"]:
+                    _, status, _ = timeline.package_at(pkg.package_id, query_time)
+                    print(f"Package ID: {pkg.package_id}          Status: {status}          Delivery Deadline: {pkg.deadline}          Delivery Address: {pkg.address}          Truck Number: {pkg.truck_assigned}")
+            else:
+                print(f"Truck {idx+1}: (No trip active at this time)")
+            continue
         # Look for a trip in the truck's history that covers the query time.
         found = False
         for trip in truck.trip_history:
@@ -509,7 +2937,8 @@ def display_truck_loads(trucks, query_time):
                 print(f"Truck {idx+1}: (No trip active at this time)")
 
 # Interactive menu for the supervisor to view statuses and mileage.
-def main_menu(package_hash, trucks):
+# A timeline built after the simulation makes the point-in-time queries in options 2, 3 and 5 faster.
+def main_menu(package_hash, trucks, timeline=None):
     while True:
         print("\nMain Menu")
         print("1. View the status of all packages")
@@ -528,7 +2957,10 @@ def main_menu(package_hash, trucks):
                 query_time = datetime.strptime(query_time, "%I:%M %p")
                 package_id = int(input("Enter the package ID: "))
                 package = package_hash.search(package_id)
-                if package:
+                if package and timeline is not None:
+                    package, status, display_address = timeline.package_at(package_id, query_time)
+                    print(f"Package ID: {package.package_id}          Delivery Status: {status}          Delivery Deadline: {package.deadline}          Delivery Address: {display_address}          Truck Number: {package.truck_assigned}")
+                elif package:
                     status = get_status_at(package, query_time)
                     display_address = get_display_address(package, query_time)
                     print(f"Package ID: {package.package_id}          Delivery Status: {status}          Delivery Deadline: {package.deadline}          Delivery Address: {display_address}          Truck Number: {package.truck_assigned}")
@@ -541,10 +2973,11 @@ def main_menu(package_hash, trucks):
                 query_time = input("Enter a time (HH:MM AM/PM): ")
                 query_time = datetime.strptime(query_time, "%I:%M %p")
                 print(f"\nPackage Status at {query_time.strftime('%I:%M %p')}:")
-                for package_id in range(1, 41):
-                    package = package_hash.search(package_id)
-                    status = get_status_at(package, query_time)
-                    display_address = get_display_address(package,query_time)
+                if timeline is not None:
+                    rows = timeline.packages_at(query_time)
+                else:
+                    rows = [(package, get_status_at(package, query_time), get_display_address(package, query_time)) for package in package_hash.values()]
+                for package, status, display_address in rows:
                     print(f"Package ID: {package.package_id}          Delivery Status: {status}          Delivery Deadline: {package.deadline}          Delivery Address: {display_address}          Truck Number: {package.truck_assigned}")
             except ValueError:
                 print("Invalid time format")
@@ -554,7 +2987,7 @@ def main_menu(package_hash, trucks):
             try:
                 query_time = input("Enter a time (HH:MM AM/PM): ")
                 query_time = datetime.strptime(query_time, "%I:%M %p")
-                display_truck_loads(trucks, query_time)
+                display_truck_loads(trucks, query_time, timeline)
             except ValueError:
                 print("Invalid time format")
         elif choice == "6":
@@ -563,47 +2996,268 @@ def main_menu(package_hash, trucks):
         else:
             print("Invalid choice. Please try again.")
 
+# Functions for the batch query mode below. Instead of the menu, queries are read one per line from a file
+# or stdin and answered against the same simulation run, and the answers are written as JSON lines or CSV.
+# Every answer row has the number of the query line it belongs to, and a query that cannot be read gives
+# an error row instead of stopping the batch. The queries look like:
+#   status 9 at 10:30 AM      (also "status of package 9 at 10:30 AM")
+#   all at 10:30 AM           (also "statuses at ..." or "all statuses at ...")
+#   loads at 10:30 AM         (also "truck loads at ...")
+#   mileage                   (also "total mileage")
+# Blank lines and lines starting with # are skipped.
+
+QUERY_PATTERNS = [
+    ("status", re.compile(r"status(?: of)?(?: package)?\s+(\d+)\s+(?:at\s+)?(.+)", re.IGNORECASE)),
+    ("all", re.compile(r"(?:all(?: statuses)?|statuses)(?:\s+at)?\s+(.+)", re.IGNORECASE)),
+    ("loads", re.compile(r"(?:truck )?loads(?:\s+at)?\s+(.+)", re.IGNORECASE)),
+    ("mileage", re.compile(r"(?:total )?mileage", re.IGNORECASE)),
+]
+QUERY_FIELDS = ["query", "type", "time", "package_id", "status", "deadline", "address", "truck", "miles", "error"]
+
+# Function to read a query time. "10:30 AM", "10:30AM" and "10:30 am" are all accepted.
+def parse_query_time(text):
+    return datetime.strptime(text.strip().upper().replace(" ", ""), "%I:%M%p")
+
+# Function to turn one line of the query file into (kind, package id, time). Raises ValueError if it can't.
+def parse_query(line):
+    for kind, pattern in QUERY_PATTERNS:
+        match = pattern.fullmatch(line.strip())
+        if match is None:
+            continue
+        if kind == "status":
+            return kind, int(match.group(1)), parse_query_time(match.group(2))
+        if kind == "mileage":
+            return kind, None, None
+        return kind, None, parse_query_time(match.group(1))
+    raise ValueError(f"unrecognized query: {line.strip()}")
+
+# Function to build one answer row for a package.
+def package_row(number, kind, query_time, package, status, address):
+    return {"query": number, "type": kind, "time": query_time.strftime('%I:%M %p'), "package_id": package.package_id,
+            "status": status, "deadline": package.deadline, "address": address, "truck": package.truck_assigned}
+
+# Function to answer one query. It yields the answer rows one at a time.
+def answer_query(number, kind, package_id, query_time, trucks, timeline):
+    if kind == "status":
+        found = timeline.package_at(package_id, query_time)
+        if found is None:
+            yield {"query": number, "type": "error", "package_id": package_id, "error": "Package not found."}
+        else:
+            yield package_row(number, kind, query_time, *found)
+    elif kind == "all":
+        for package, status, address in timeline.packages_at(query_time):
+            yield package_row(number, kind, query_time, package, status, address)
+    elif kind == "loads":
+        for idx in range(len(trucks)):
+            trip = timeline.trip_at(idx, query_time)
+            if trip is None:
+                yield {"query": number, "type": kind, "time": query_time.strftime('%I:%M %p'), "truck": idx + 1,
+                       "status": "No trip active at this time"}
+                continue
+            for pkg in trip["packages"]:
+                _, status, _ = timeline.package_at(pkg.package_id, query_time)
+                yield package_row(number, kind, query_time, pkg, status, pkg.address)
+    else:
+        for idx, truck in enumerate(trucks):
+            yield {"query": number, "type": kind, "truck": idx + 1, "miles": round(float(truck.total_distance), 2)}
+        total = sum(truck.total_distance for truck in trucks)
+        yield {"query": number, "type": kind, "truck": "all", "miles": round(float(total), 2)}
+
+# Function to answer every query in lines and write the rows to output as they are produced.
+# Returns the number of queries that could not be read or answered.
+def run_batch_queries(lines, output, trucks, timeline, output_format="jsonl"):
+    if output_format == "csv":
+        writer = csv.DictWriter(output, fieldnames=QUERY_FIELDS, restval="")
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda row: output.write(json.dumps(row) + "\n")
+    errors = 0
+    for number, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        try:
+            kind, package_id, query_time = parse_query(line)
+        except ValueError as e:
+            errors += 1
+            write({"query": number, "type": "error", "error": str(e)})
+            continue
+        for row in answer_query(number, kind, package_id, query_time, trucks, timeline):
+            if row["type"] == "error":
+                errors += 1
+            write(row)
+    output.flush()
+    return errors
+
+# Function to import matplotlib.pyplot the first time a chart is drawn.
+# The charts are only saved to files, so I use the Agg backend, which also works outside the main thread.
+def load_pyplot():
+    global plt
+    if plt is None:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot
+        plt = matplotlib.pyplot
+    return plt
+
+# Function to start drawing the charts in a background thread, so the menu or batch queries can start right away.
+# It returns the thread and the list its messages are collected in; finish_charts waits for it and prints them.
+def start_background_charts(package_hash, trucks, addresses, distances):
+    messages = []
+    thread = threading.Thread(
+        target=generate_visualizations,
+        args=(package_hash, trucks, addresses, distances, messages.append),
+        name="charts"
+    )
+    thread.start()
+    return thread, messages
+
+def finish_charts(thread, messages):
+    thread.join()
+    for message in messages:
+        print(message)
+
+# Define a local HTTP service that answers the same queries as the batch mode, for a dispatch UI that polls.
+# It only uses the finished simulation: the trucks and the EventTimeline built from them are never changed,
+# so every answer for a given path and time is the same, and the encoded responses are cached.
+# Requests are handled by asyncio on one thread, and connections are kept open between requests.
+#   GET /packages/<id>?time=10:30 AM    one package
+#   GET /packages?time=10:30 AM         every package
+#   GET /trucks?time=10:30 AM           the packages on each truck
+#   GET /mileage                        miles per truck and in total
+class QueryService:
+    ROUTES = {"packages": "all", "trucks": "loads", "mileage": "mileage"}
+    REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+    def __init__(self, trucks, timeline, cache_size=4096):
+        self.trucks = trucks
+        self.timeline = timeline
+        self.respond = lru_cache(maxsize=cache_size)(self._respond)
+
+    # Returns (status code, JSON body) for a path and an already parsed query time.
+    def _respond(self, path, query_time):
+        parts = path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "packages" and parts[1].isdigit():
+            kind, package_id = "status", int(parts[1])
+        elif len(parts) == 1 and parts[0] in QueryService.ROUTES:
+            kind, package_id = QueryService.ROUTES[parts[0]], None
+        else:
+            return 404, json.dumps({"error": f"unknown path: {path}"}).encode()
+        if kind != "mileage" and query_time is None:
+            return 400, json.dumps({"error": "a time is required, for example ?time=10:30 AM"}).encode()
+        rows = list(answer_query(None, kind, package_id, query_time, self.trucks, self.timeline))
+        for row in rows:
+            del row["query"]
+        if kind == "status":
+            return (404 if rows[0]["type"] == "error" else 200), json.dumps(rows[0]).encode()
+        return 200, json.dumps({"results": rows}).encode()
+
+    # Handles one request and returns (status code, JSON body).
+    def answer(self, method, target):
+        if method != "GET":
+            return 405, json.dumps({"error": "only GET is supported"}).encode()
+        url = urlsplit(target)
+        times = parse_qs(url.query).get("time")
+        try:
+            query_time = parse_query_time(times[0]) if times else None
+        except ValueError:
+            return 400, json.dumps({"error": f"invalid time: {times[0]}"}).encode()
+        return self.respond(url.path, query_time)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip().lower()
+                # A request body is read and dropped so it is not taken for the next request. A body whose length
+                # is not given can't be skipped, so the connection is closed after the reply.
+                length = headers.get("content-length", "0")
+                framed = length.isdigit() and "transfer-encoding" not in headers
+                if length.isdigit():
+                    await reader.readexactly(int(length))
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    status, body = 400, json.dumps({"error": "malformed request"}).encode()
+                    version = "HTTP/1.0"
+                else:
+                    status, body = self.answer(method, target)
+                keep_alive = (version == "HTTP/1.1" and headers.get("connection") != "close" and status != 400
+                              and framed)
+                writer.write(
+                    f"HTTP/1.1 {status} {QueryService.REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port=8000, ready=None):
+        # The service only listens on the loopback address, so it is not reachable from other machines.
+        server = await asyncio.start_server(self.handle, "127.0.0.1", port)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            print(f"Serving on http://127.0.0.1:{port} (Ctrl+C to stop)")
+            if ready is not None:
+                ready(port)
+            await server.serve_forever()
+
 # Creates and saves three visuals for Part C/D of the capstone.
 # Each visualization is saved as a PNG file and closed after saving so figures don't overlap or block execution.
-def generate_visualizations(package_hash, trucks, addresses, distances):
+# Messages go through log, so a background render can hold them until the main thread prints them.
+def generate_visualizations(package_hash, trucks, addresses, distances, log=print):
+    load_pyplot()
 
     try:
         # Histogram of delivery times (minutes since 8:00 AM)
         plot_delivery_time_histogram(package_hash)
         plt.savefig("delivery_times_hist.png", bbox_inches="tight")
-        print("Saved: delivery_times_hist.png")
+        log("Saved: delivery_times_hist.png")
         plt.close()
     except Exception as e:
-        print(f"Could not generate delivery time histogram: {e}")
+        log(f"Could not generate delivery time histogram: {e}")
 
     try:
         # Bar chart comparing baseline vs. optimized total mileage
         plot_mileage_comparison(trucks)
         plt.savefig("mileage_comparison.png", bbox_inches="tight")
-        print("Saved: mileage_comparison.png") 
+        log("Saved: mileage_comparison.png") 
         plt.close()
     except Exception as e:
-        print(f"Could not generate mileage comparison: {e}")
+        log(f"Could not generate mileage comparison: {e}")
 
     try:
         # Bar chart showing miles traveled by each truck
         plot_miles_per_truck(trucks)
         plt.savefig("miles_per_truck.png", bbox_inches="tight")
-        print("Saved: miles_per_truck.png")
+        log("Saved: miles_per_truck.png")
         plt.close()
     except Exception as e:
-        print(f"Could not generate route diagram: {e}")
+        log(f"Could not generate route diagram: {e}")
 
 #Create a histogram of package delivery times (minutes after 8:00 AM).
 # Uses the delivery_time attribute recorded for each package.
 def plot_delivery_time_histogram(package_hash):
-    base = datetime.strptime("8:00 AM", "%I:%M %p")
+    base = DAY_START
     mins_since_base = []
 
     #collect delivery times (hour of day)
-    for pkg_id in range(1,41):
-        pkg = package_hash.search(pkg_id)
-        if pkg and getattr(pkg, "delivery_time", None):
+    for pkg in package_hash.values():
+        if getattr(pkg, "delivery_time", None):
             delta_min = (pkg.delivery_time - base).total_seconds() / 60.0
             if delta_min >= 0:
                 mins_since_base.append(delta_min)
@@ -639,23 +3293,18 @@ def plot_miles_per_truck(trucks):
 
 
 
-# Main function where the simulation and user interface are initiated.
-def main():
-    # I load package data from the WGUPS package CSV file.
-    package_hash = load_package_data("./WGUPS_Package_File.csv")
-    # I load distance and address data from the WGUPS distance table CSV file.
-    distances, addresses = load_distance_data("./WGUPS_Distance_Table.csv")
-
-    # I create two Truck objects.
-    trucks = [Truck() for _ in range(2)]
-
-    # Start truck 2 at 9:05 AM so it can "wait" on the delayed packages
-    trucks[1].current_time = datetime.strptime("9:05 AM", "%I:%M %p")
-
-    # I simulate the delivery process, ensuring each truck carries at most 16 packages per trip.
-    simulate_deliveries(trucks, addresses, distances, package_hash)
+# Function to print the profiling report as JSON, and save it to a file if one was given.
+def print_profile_report(report, filename=None):
+    text = json.dumps(report, indent=2)
+    print("\nProfiling report:")
+    print(text)
+    if filename:
+        with open(filename, 'w') as file:
+            file.write(text)
+        print(f"Saved: {filename}")
 
-    # After simulation, I display the total mileage and launch the interactive menu for further queries.
+# Function to print the mileage summary after the simulation.
+def summarize_run(trucks, package_hash=None):
     display_total_mileage(trucks)
 
     actual_total = sum(t.total_distance for t in trucks)
@@ -669,9 +3318,201 @@ def main():
     else:
         print("Baseline miles not available (no initial routes recorded).")
 
-    generate_visualizations(package_hash, trucks, addresses, distances)
-    main_menu(package_hash, trucks)
+    if package_hash is not None:
+        late = missed_deadlines(package_hash)
+        print(f"Missed deadlines:                {len(late) or 'none'}")
+        for pkg in late:
+            print(f"  Package {pkg.package_id}: due {pkg.deadline}, "
+                  f"delivered {pkg.delivery_time.strftime('%I:%M %p')} (Truck {pkg.truck_assigned})")
+
+# Function to read the command line options.
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Gateway Parcel Co. St. Louis Routing Application")
+    parser.add_argument("--trucks", type=int, default=2, help="number of trucks in the fleet")
+    parser.add_argument("--capacity", type=int, default=16, help="packages each truck can carry per trip")
+    parser.add_argument("--speed", type=float, default=18, help="average truck speed in miles per hour")
+    parser.add_argument("--dispatcher", choices=["cycles", "events"], default="cycles",
+                        help="cycles loads every truck in lockstep (truck 2 waits for the 9:05 AM flight); "
+                             "events sends each load to whichever truck is back at the hub first")
+    parser.add_argument("--partition", choices=["priority", "clusters"], default="priority",
+                        help="priority fills the trucks in priority order; clusters then regroups each cycle's "
+                             "packages by location so every truck gets nearby stops (cycles dispatcher only)")
+    parser.add_argument("--store", choices=["hash", "columnar"], default="hash",
+                        help="keep packages in the hash table or in the columnar store (for very large manifests)")
+    parser.add_argument("--raw-distances", action="store_true",
+                        help="use the distance table as it is instead of the shortest path between every two locations")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="optimize truck routes in this many worker processes (0 runs them in this process)")
+    parser.add_argument("--starts", type=int, default=1,
+                        help="number of randomized 2-opt starts per truck route when using workers")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the randomized starts")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="optimize each route with 2-opt and Or-opt for at most this many seconds "
+                             "and keep the best route found")
+    parser.add_argument("--perturb", action="store_true",
+                        help="with --time-budget, spend the rest of the budget on random kicks with "
+                             "simulated-annealing acceptance")
+    parser.add_argument("--ignore-deadlines", action="store_false", dest="on_time",
+                        help="route for the fewest miles even if a package ends up late; by default 2-opt only "
+                             "makes moves that keep every package on time, starting from a deadline-first route "
+                             "when the nearest neighbor route misses a deadline (--workers and --time-budget "
+                             "always route for the fewest miles)")
+    parser.add_argument("--scenarios", default=None,
+                        help="run the what-if scenarios in this JSON file (see expand_scenarios) instead of the "
+                             "normal day, in --workers processes (0 runs them in this process)")
+    parser.add_argument("--scenario-output", default="-",
+                        help="write the scenario results table to this CSV file (- for stdout)")
+    parser.add_argument("--profile", action="store_true",
+                        help="time each phase, track peak memory and count hot-path calls, then print a JSON report "
+                             "(charts are drawn before the menu instead of in the background, so they are timed too)")
+    parser.add_argument("--profile-output", default=None, help="also write the profiling report to this JSON file")
+    parser.add_argument("--queries", default=None,
+                        help="answer the queries in this file (- for stdin) instead of opening the menu; "
+                             "the answers go to stdout and everything else to stderr")
+    parser.add_argument("--query-format", choices=["jsonl", "csv"], default="jsonl",
+                        help="write query answers as JSON lines or CSV")
+    parser.add_argument("--event", action="append", default=[], dest="events",
+                        help="after the simulation, apply a live change and re-plan only the trucks it affects, "
+                             "e.g. \"10:20 AM address 9 410 S State St\", \"9:45 AM available 25\", "
+                             "\"11:00 AM breakdown 1\" or \"10:00 AM package 41,<address>,<city>,...\" (repeatable)")
+    parser.add_argument("--event-log", default=None,
+                        help="save the simulated day's event log to this file (it can be opened with EventLog.load)")
+    parser.add_argument("--serve", action="store_true",
+                        help="answer queries over HTTP on localhost instead of opening the menu (see QueryService)")
+    parser.add_argument("--port", type=int, default=8000, help="port for --serve (0 picks a free port)")
+    parser.add_argument("--charts", choices=["background", "foreground", "off"], default=None,
+                        help="draw the charts in a background thread while the menu runs (the default), "
+                             "before the menu, or not at all (the default with --queries)")
+    args = parser.parse_args(argv)
+    if args.serve and args.queries:
+        parser.error("--serve and --queries cannot be used together")
+    if args.trucks < 1 or args.capacity < 1 or args.speed <= 0:
+        parser.error("--trucks, --capacity and --speed must be positive")
+    if args.perturb and args.time_budget is None:
+        parser.error("--perturb needs --time-budget")
+    if args.partition == "clusters" and args.dispatcher == "events":
+        parser.error("--partition clusters needs the cycles dispatcher, which loads every truck at once")
+    return args
+
+# Main function where the simulation and user interface are initiated.
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile or args.profile_output:
+        enable_profiling()
+    with profile_phase("load"):
+        # I load package data from the WGUPS package CSV file.
+        package_hash = load_package_data("./WGUPS_Package_File.csv", columnar=args.store == "columnar")
+        # I load distance and address data from the WGUPS distance table CSV file.
+        distances, addresses = load_distance_data("./WGUPS_Distance_Table.csv", shortest_paths=not args.raw_distances)
+        # Every package address is looked up in the distance table once here and kept as a location id.
+        assign_location_ids(package_hash.values(), distances)
+
+    if args.scenarios:
+        try:
+            with open(args.scenarios) as file:
+                scenarios = expand_scenarios(json.load(file))
+        except (OSError, ValueError) as e:
+            print(f"Could not read scenarios from {args.scenarios}: {e}", file=sys.stderr)
+            return 2
+        start = time.perf_counter()
+        rows = run_scenarios(scenarios, "./WGUPS_Package_File.csv", distances, args.workers)
+        # The worker processes are not profiled, so with workers the "scenarios" phase is the wall time only.
+        with profile_phase("scenarios"):
+            if args.scenario_output == "-":
+                results = write_scenario_results(rows, sys.stdout)
+            else:
+                with open(args.scenario_output, "w", newline="") as output:
+                    results = write_scenario_results(rows, output)
+        with redirect_stdout(sys.stderr):
+            summarize_scenarios(results, time.perf_counter() - start)
+            report = disable_profiling()
+            if report is not None:
+                print_profile_report(report, args.profile_output)
+        return 0
+
+    # I create the Truck objects.
+    trucks = [Truck(args.capacity, args.speed) for _ in range(args.trucks)]
+
+    # The event dispatcher treats the delayed flight as a scheduled event, so every truck can leave at 8:00 AM.
+    simulate = dispatch_deliveries if args.dispatcher == "events" else partial(simulate_deliveries, partition=args.partition)
+    if args.dispatcher == "cycles" and len(trucks) > 1:
+        # Start truck 2 at 9:05 AM so it can "wait" on the delayed packages
+        trucks[1].current_time = DELAYED_ARRIVAL
+
+    # I simulate the delivery process, ensuring each truck carries at most its capacity per trip.
+    if args.workers > 0:
+        optimizer = ParallelRouteOptimizer(distances, args.workers, args.starts, args.seed, args.time_budget, args.perturb)
+    elif args.time_budget is not None:
+        optimizer = AnytimeRouteOptimizer(distances, args.time_budget, args.perturb, args.seed)
+    else:
+        optimizer = None
+    try:
+        with optimizer or nullcontext():
+            simulate(trucks, addresses, distances, package_hash, optimizer=optimizer, on_time=args.on_time)
+    except RuntimeError as e:
+        # A package that can only go on a truck the fleet doesn't have can never be delivered.
+        print(f"Could not finish the deliveries with {args.trucks} truck(s): {e}", file=sys.stderr)
+        return 1
+    if args.event_log:
+        # The log holds the day as simulated; live events below re-plan a copy of the trips.
+        trucks[0].log.save(args.event_log)
+
+    if args.events:
+        plan = LivePlan(trucks, package_hash, distances)
+        for event in args.events:
+            start = time.perf_counter()
+            try:
+                replanned = apply_live_event(plan, event)
+            except (ValueError, RuntimeError) as e:
+                print(f"Could not apply event \"{event}\": {e}", file=sys.stderr)
+                return 2
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"Event \"{event}\": re-planned truck(s) {', '.join(map(str, replanned)) or 'none'} in {elapsed:.1f} ms",
+                  file=sys.stderr if args.queries else sys.stdout)
+
+    # Charts are drawn in the background by default so the menu is ready sooner. Batch queries skip them.
+    charts = args.charts or ("off" if args.queries else "background")
+    # The report is printed before the menu opens, so with profiling the charts are drawn first and timed
+    # as the "render" phase instead of in the background.
+    if charts == "background" and PROFILER is not None:
+        charts = "foreground"
+    # In batch query mode stdout only carries the answers, so the summary and the report go to stderr.
+    log_output = sys.stderr if args.queries else sys.stdout
+    with redirect_stdout(log_output):
+        # After simulation, I display the total mileage and launch the interactive menu for further queries.
+        summarize_run(trucks, package_hash)
+        if charts == "foreground":
+            with profile_phase("render"):
+                generate_visualizations(package_hash, trucks, addresses, distances)
+        # The profiling report covers everything up to the interactive menu.
+        report = disable_profiling()
+        if report is not None:
+            print_profile_report(report, args.profile_output)
+    background = None
+    if charts == "background":
+        background = start_background_charts(package_hash, trucks, addresses, distances)
+    # I build the event timeline once so the menu's point-in-time queries don't rescan the trip history.
+    timeline = EventTimeline(package_hash, trucks)
+    errors = 0
+    if args.queries:
+        if args.queries == "-":
+            errors = run_batch_queries(sys.stdin, sys.stdout, trucks, timeline, args.query_format)
+        else:
+            with open(args.queries) as file:
+                errors = run_batch_queries(file, sys.stdout, trucks, timeline, args.query_format)
+    elif args.serve:
+        try:
+            asyncio.run(QueryService(trucks, timeline).serve(args.port))
+        except KeyboardInterrupt:
+            print("\nStopped serving.")
+    else:
+        main_menu(package_hash, trucks, timeline)
+    # The program does not exit until the background charts are saved.
+    if background is not None:
+        with redirect_stdout(log_output):
+            finish_charts(*background)
+    return 1 if errors else 0
 
 # Entry point of the program.
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file